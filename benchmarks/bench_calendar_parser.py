@@ -0,0 +1,57 @@
+# benchmarks/bench_calendar_parser.py
+#
+# カレンダーページの解析速度を、従来のBeautifulSoup(html.parser)版と高速パーサーで比較する
+# 先にfixtures内の全ページで両者の結果が一致することを確かめてから計測する
+#
+#   python benchmarks/bench_calendar_parser.py [--number 200]
+
+from pathlib import Path
+import argparse
+import logging
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bs4 import BeautifulSoup
+from calendar_parser import parse_available_dates
+from scraper import extract_available_dates
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+
+def parse_with_bs4(content):
+    soup = BeautifulSoup(content, "html.parser")
+    return extract_available_dates(soup, "bench")
+
+def parse_with_fast_parser(content):
+    return parse_available_dates(content, "bench")
+
+def main():
+    parser = argparse.ArgumentParser(description="カレンダーページ解析のマイクロベンチマーク")
+    parser.add_argument("--number", type=int, default=200, help="1ページあたりの繰り返し回数")
+    args = parser.parse_args()
+
+    # 空き日ごとのINFOログが計測に混ざらないようにする
+    logging.disable(logging.INFO)
+
+    pages = sorted(FIXTURES_DIR.glob("empty_calendar*.html"))
+    if not pages:
+        sys.exit(f"フィクスチャが見つかりません: {FIXTURES_DIR}")
+
+    for page in pages:
+        content = page.read_bytes()
+        expected = parse_with_bs4(content)
+        actual = parse_with_fast_parser(content)
+        if actual != expected:
+            sys.exit(f"結果が一致しません: {page.name}\n  bs4 : {expected}\n  fast: {actual}")
+
+        bs4_seconds = timeit.timeit(lambda: parse_with_bs4(content), number=args.number) / args.number
+        fast_seconds = timeit.timeit(lambda: parse_with_fast_parser(content), number=args.number) / args.number
+        print(
+            f"{page.name}: 空き日 {len(expected)} 件 | "
+            f"bs4 {bs4_seconds * 1000:.3f} ms | fast {fast_seconds * 1000:.3f} ms | "
+            f"{bs4_seconds / fast_seconds:.1f} 倍"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+# benchmarks/bench_pipeline.py
+#
+# スクレイピング→差分→通知までの1回のスキャン(main.main())を、外部サービスなしで計測する
+#   - its-kenpo: ローカルのHTTPサーバーが施設一覧とempty_calendarページを返す（遅延を注入できる）
+#   - DB: db_utils の問い合わせをメモリ上の代替実装に差し替え、呼び出し回数を数える
+#   - LINE: push/multicastを受けるだけのローカルHTTPサーバーに送る
+# 各シナリオでウォール時間、HTTPリクエスト数、DB往復数、送信数、ピークメモリを表示する
+#
+#   python benchmarks/bench_pipeline.py --users 10,100,1000 --facilities 5,50 --latency 0.05
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+import argparse
+import calendar
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+CATALOG_ID = "PT13TjJjVFBrbG1KbFZuYzAxVFp5Vkhkd0YyWWZWR2JuOTJiblpTWjFKSGQ5a0hkdzFXWg"
+
+# ---------------------------------------------------------------------------
+# its-kenpo の代替サーバー
+# ---------------------------------------------------------------------------
+
+class FakeKenpo:
+    """施設一覧と月別カレンダーを、fixtures/empty_calendar.html と同じ構造のHTMLで返す"""
+
+    def __init__(self, facility_count, latency, availability_rate, churn):
+        self.facility_ids = [f"F{i:04d}" for i in range(facility_count)]
+        self.latency = latency
+        self.availability_rate = availability_rate
+        self.churn = churn
+        self.generation = 0  # 実行ごとに増やし、churnの割合だけ空き状況を入れ替える
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def catalog_page(self):
+        items = "\n".join(
+            f'    <li data-href="/apply/empty_calendar?s={facility_id}"><span>ベンチ施設{facility_id}</span></li>'
+            for facility_id in self.facility_ids
+        )
+        return (
+            '<!DOCTYPE html>\n<html lang="ja">\n<head><meta charset="UTF-8"><title>空き状況カレンダー</title></head>\n'
+            f'<body>\n  <ul id="top_tabs">\n{items}\n  </ul>\n</body>\n</html>\n'
+        )
+
+    def calendar_page(self, facility_id, year, month):
+        rows = []
+        for week in calendar.Calendar(firstweekday=6).monthdatescalendar(year, month):
+            cells = []
+            for day in week:
+                if day.month != month:
+                    cells.append('          <td class="other-month"></td>')
+                    continue
+                rng = random.Random(f"{facility_id}:{day}")
+                available = rng.random() < self.availability_rate
+                # 世代ごとに一部のセルだけ空き⇔満室を入れ替える
+                if random.Random(f"{facility_id}:{day}:{self.generation}").random() < self.churn:
+                    available = not available
+                status, icon_class = ("○", "icon icon-ok") if available else ("☓", "icon icon-full")
+                cells.append(
+                    f'          <td class="day" data-join-time="{day}" data-night-count="1">\n'
+                    f'            <span class="day-num">{day.day}</span>\n'
+                    f'            <span class="{icon_class}">{status}</span>\n'
+                    f'          </td>'
+                )
+            rows.append("        <tr>\n" + "\n".join(cells) + "\n        </tr>")
+        return (
+            '<!DOCTYPE html>\n<html lang="ja">\n<head><meta charset="UTF-8"><title>空き状況カレンダー</title></head>\n'
+            f'<body>\n  <div class="calendar">\n    <h2>{year}年{month}月</h2>\n    <table class="calendar-table">\n      <tbody>\n'
+            + "\n".join(rows)
+            + "\n      </tbody>\n    </table>\n  </div>\n</body>\n</html>\n"
+        )
+
+    def handler(self):
+        kenpo = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-aliveを有効にする
+
+            def do_GET(self):
+                kenpo.count()
+                if kenpo.latency:
+                    time.sleep(kenpo.latency)
+                query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+                facility_id = query.get("s", [""])[0]
+                join_date = query.get("join_date", [""])[0]
+
+                if facility_id.startswith(CATALOG_ID[:8]) and not join_date:
+                    body = kenpo.catalog_page()
+                else:
+                    year, month = int(join_date[:4]), int(join_date[5:7])
+                    body = kenpo.calendar_page(facility_id, year, month)
+
+                payload = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=UTF-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+# ---------------------------------------------------------------------------
+# LINE Messaging API の代替サーバー
+# ---------------------------------------------------------------------------
+
+class FakeLine:
+    """push/multicastを受け取り、リクエスト数・宛先数・メッセージ数を数える"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.recipients = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def handler(self):
+        line = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                if line.latency:
+                    time.sleep(line.latency)
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                to = data.get("to", [])
+                with line._lock:
+                    line.requests += 1
+                    line.recipients += len(to) if isinstance(to, list) else 1
+                    line.messages += len(data.get("messages", []))
+
+                payload = b"{}"
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# ---------------------------------------------------------------------------
+# db_utils の代替（メモリ上）
+# ---------------------------------------------------------------------------
+
+class InMemoryDB:
+    """main.py が使う db_utils の関数をメモリ上で再現し、呼び出し＝DB往復として数える"""
+
+    def __init__(self, wishes):
+        self.facilities = {}
+        self.wishes = wishes  # [(user_id, facility_id, created_at, conditions)]
+        self.snapshots = {}
+        self.fingerprints = {}
+        self.round_trips = 0
+
+    def _trip(self):
+        self.round_trips += 1
+
+    def save_facilities(self, facilities):
+        self._trip()
+        self.facilities.update({facility["id"]: facility["name"] for facility in facilities})
+        return True
+
+    def fetch_wished_facilities(self):
+        self._trip()
+        return [
+            {"user_id": user_id, "facility_id": facility_id,
+             "facility_name": self.facilities.get(facility_id, facility_id), "created_at": created_at,
+             "conditions": conditions}
+            for user_id, facility_id, created_at, conditions in self.wishes
+            if facility_id in self.facilities
+        ]
+
+    def fetch_wished_facilities_by_facility(self, facility_ids):
+        wanted = set(facility_ids)
+        return [row for row in self.fetch_wished_facilities() if row["facility_id"] in wanted]
+
+    def fetch_availability_snapshots(self, facility_ids):
+        self._trip()
+        return {facility_id: self.snapshots[facility_id] for facility_id in facility_ids if facility_id in self.snapshots}
+
+    def save_availability_snapshots(self, snapshots):
+        self._trip()
+        now = datetime.now()
+        for facility_id, dates in snapshots.items():
+            self.snapshots[facility_id] = {"available_dates": list(dates), "scanned_at": now, "age_seconds": 0.0}
+
+    def fetch_calendar_fingerprints(self, facility_ids):
+        self._trip()
+        return {facility_id: dict(self.fingerprints[facility_id]) for facility_id in facility_ids if facility_id in self.fingerprints}
+
+    def save_calendar_fingerprints(self, fingerprints, current_month):
+        self._trip()
+        for facility_id, months in fingerprints.items():
+            self.fingerprints.setdefault(facility_id, {}).update(months)
+
+    def ensure_schema(self):
+        return True
+
+    def patch(self, module):
+        for name in ("ensure_schema", "save_facilities", "fetch_wished_facilities", "fetch_wished_facilities_by_facility",
+                     "fetch_availability_snapshots", "save_availability_snapshots",
+                     "fetch_calendar_fingerprints", "save_calendar_fingerprints"):
+            setattr(module, name, getattr(self, name))
+
+# ---------------------------------------------------------------------------
+# 実行
+# ---------------------------------------------------------------------------
+
+def run_scenario(main_module, scraper_module, users, facility_count, args, line, line_url):
+    from linebot import LineBotApi
+
+    kenpo = FakeKenpo(facility_count, args.latency, args.availability, args.churn)
+    kenpo_server, kenpo_url = serve(kenpo.handler())
+
+    # 購読は各ユーザーが施設からランダムに選ぶ（シードで固定）
+    # --next-month-only の割合のユーザーは、来月の日付だけを通知する条件をつける
+    from wish_conditions import NO_CONDITIONS
+    rng = random.Random(f"{users}:{facility_count}")
+    created_at = datetime.now().replace(year=2000)
+    next_month = scraper_module.bookable_months()[1:2]
+    next_month_only = dict(NO_CONDITIONS)
+    if next_month:
+        last_day = calendar.monthrange(next_month[0].year, next_month[0].month)[1]
+        next_month_only.update(date_from=next_month[0].strftime("%Y-%m-%d"), date_to=next_month[0].replace(day=last_day).strftime("%Y-%m-%d"))
+    wishes = []
+    for i in range(users):
+        conditions = next_month_only if rng.random() < args.next_month_only else NO_CONDITIONS
+        for facility_id in rng.sample(kenpo.facility_ids, min(args.wishes_per_user, facility_count)):
+            wishes.append((f"U{i:05d}", facility_id, created_at, conditions))
+
+    db = InMemoryDB(wishes)
+    db.patch(main_module)
+    main_module.line_bot_api = LineBotApi("bench-token", endpoint=line_url)
+
+    # スクレイピング先をこのシナリオの代替サーバーに向け、プロセス内キャッシュを捨てる
+    main_module.KENPO_BASE_URL = scraper_module.KENPO_BASE_URL = kenpo_url
+    scraper_module.invalidate_facility_catalog()
+
+    results = []
+    for run in range(args.runs):
+        kenpo.generation = run
+        scraper_module.calendar_cache.clear()  # 実際の定期実行はキャッシュの有効期間より間隔が空く
+        kenpo.requests = 0
+        db.round_trips = 0
+        line.reset()
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        main_module.main()
+        wall = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({
+            "users": users, "facilities": facility_count, "wishes": len(wishes), "run": run + 1,
+            "wall_seconds": wall, "http_requests": kenpo.requests, "db_round_trips": db.round_trips,
+            "push_requests": line.requests, "push_recipients": line.recipients,
+            "peak_memory_mb": peak / 1024 / 1024
+        })
+
+    kenpo_server.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="スキャン全体（scrape→diff→notify）のベンチマーク")
+    parser.add_argument("--users", default="10,100,1000", help="ユーザー数（カンマ区切り）")
+    parser.add_argument("--facilities", default="5,50", help="施設数（カンマ区切り）")
+    parser.add_argument("--wishes-per-user", type=int, default=3, help="1ユーザーあたりの登録施設数")
+    parser.add_argument("--latency", type=float, default=0.05, help="its-kenpo代替サーバーの応答遅延（秒）")
+    parser.add_argument("--line-latency", type=float, default=0.01, help="LINE代替サーバーの応答遅延（秒）")
+    parser.add_argument("--availability", type=float, default=0.3, help="空きセルの割合")
+    parser.add_argument("--churn", type=float, default=0.05, help="実行ごとに空き状況が入れ替わるセルの割合")
+    parser.add_argument("--next-month-only", type=float, default=0.0, help="来月だけを通知する条件をつけるユーザーの割合（0〜1）")
+    parser.add_argument("--runs", type=int, default=2, help="シナリオごとの連続実行回数（2回目以降は差分通知になる）")
+    parser.add_argument("--log-level", default="WARNING", help="計測中のログレベル")
+    parser.add_argument("--json", action="store_true", help="結果をJSON Linesで出力する")
+    args = parser.parse_args()
+
+    # main.py の import 前に、LINEの認証情報と代替サーバーを設定しておく
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench-token")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "bench-secret")
+    os.environ.pop("DATABASE_URL", None)
+    sys.path.insert(0, str(ROOT_DIR))
+
+    line = FakeLine(args.line_latency)
+    line_server, line_url = serve(line.handler())
+
+    import main as main_module
+    import scraper as scraper_module
+    from logging_setup import setup_logging
+    setup_logging()
+    logging.getLogger().setLevel(args.log_level)
+    for name in ("main", "scraper", "db_utils", "notifier", "calendar_parser"):
+        logging.getLogger(name).setLevel(args.log_level)
+
+    if not args.json:
+        print(f"{'users':>6} {'fac':>4} {'wishes':>6} {'run':>3} {'wall[s]':>8} {'http':>6} {'db':>4} {'push':>5} {'recip':>6} {'peak[MB]':>9}")
+
+    for users in [int(value) for value in args.users.split(",")]:
+        for facility_count in [int(value) for value in args.facilities.split(",")]:
+            for result in run_scenario(main_module, scraper_module, users, facility_count, args, line, line_url):
+                if args.json:
+                    print(json.dumps(result, ensure_ascii=False))
+                else:
+                    print(
+                        f"{result['users']:>6} {result['facilities']:>4} {result['wishes']:>6} {result['run']:>3} "
+                        f"{result['wall_seconds']:>8.2f} {result['http_requests']:>6} {result['db_round_trips']:>4} "
+                        f"{result['push_requests']:>5} {result['push_recipients']:>6} {result['peak_memory_mb']:>9.1f}"
+                    )
+
+    line_server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# calendar_parser.py
+
+from html import unescape
+import hashlib
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# empty_calendarページの空き日セル
+#   <td data-join-time="2025-07-01" data-night-count="1"> ... <span class="icon">○</span> ... </td>
+# をBeautifulSoupで木を作らずに、生のバイト列から正規表現で直接抜き出す
+# 開始タグの中身　引用符で囲んだ属性値の中の ">" ではタグが終わらない
+TAG_BODY = rb"""(?:[^>"']|"[^"]*"|'[^']*')*"""
+TD_RE = re.compile(rb"<td\b(" + TAG_BODY + rb")>", re.IGNORECASE)
+# 開始タグ（group(1)が属性）と終了タグ　入れ子を数えて対応する終了タグを探すのに使う
+TD_TAG_RE = re.compile(rb"<td\b(" + TAG_BODY + rb")>|</td\s*>", re.IGNORECASE)
+SPAN_TAG_RE = re.compile(rb"<span\b(" + TAG_BODY + rb")>|</span\s*>", re.IGNORECASE)
+ATTR_RE = re.compile(rb"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?""")
+TAG_RE = re.compile(rb"<" + TAG_BODY + rb">")
+# html.parserがセルとして扱わない部分（コメントと、script/styleの中身）
+NON_MARKUP_RE = re.compile(rb"<!--.*?-->|<(script|style)\b" + TAG_BODY + rb">.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+UNCLOSED_RE = re.compile(rb"<!--|<script\b|<style\b", re.IGNORECASE)
+
+JOIN_TIME_MARKER = b"data-join-time"
+FULL_MARK = "☓"  # 満室を表すアイコン
+
+class CalendarParseError(Exception):
+    """高速パーサーでページ構造を解釈できなかったときに送出する（呼び出し側でBeautifulSoupに切り替える）"""
+
+def _parse_attrs(raw):
+    attrs = {}
+    for match in ATTR_RE.finditer(raw):
+        name = match.group(1).lower()
+        value = match.group(2) if match.group(2) is not None else match.group(3) if match.group(3) is not None else match.group(4)
+        # html.parserと同じく、同名の属性は最初のものを採用する
+        if name not in attrs:
+            attrs[name] = b"" if value is None else value
+    return attrs
+
+# start以降で、すでに1つ開いているタグに対応する終了タグの位置を返す（見つからなければNone）
+# html.parserの木と同じく、セルの中の表（<table><td>...）やspanの入れ子は内側から閉じていく
+def _matching_end(tag_re, content, start):
+    depth = 1
+    for tag in tag_re.finditer(content, start):
+        depth += 1 if tag.group(1) is not None else -1
+        if depth == 0:
+            return tag.start()
+    return None
+
+def _decode(value, encoding):
+    return unescape(value.decode(encoding))
+
+# カレンダーページのバイト列から、1泊の空き日（YYYY-MM-DD）をページ内の順序で返す
+# 結果は scraper.extract_available_dates(BeautifulSoup(content, "html.parser"), ...) と同じになる
+def parse_available_dates(content, facility_id, encoding="utf-8"):
+    if isinstance(content, str):
+        content = content.encode(encoding)
+
+    # コメントの中の<td>や<span>を拾わないよう先に取り除く　閉じていないものがあれば解析しない
+    content = NON_MARKUP_RE.sub(b"", content)
+    if UNCLOSED_RE.search(content):
+        raise CalendarParseError("閉じていないコメントまたはscript/styleがあります")
+
+    available_dates = []
+    marker_count = content.count(JOIN_TIME_MARKER)  # data-join-timeの文字列の出現数
+    cell_count = 0  # 属性として読み取れた<td>の数
+
+    try:
+        for td in TD_RE.finditer(content):
+            if JOIN_TIME_MARKER not in td.group(1):
+                continue
+            attrs = _parse_attrs(td.group(1))
+            if b"data-join-time" not in attrs:
+                continue
+            cell_count += 1
+            if attrs.get(b"data-night-count") != b"1":
+                continue
+
+            # セルの範囲（対応する</td>まで）で、入れ子の中も含めて最初の class="icon" のspanを探す
+            # 閉じていないセルはhtml.parserが後ろのセルまで取り込むので、ここでは解析しない
+            cell_end = _matching_end(TD_TAG_RE, content, td.end())
+            if cell_end is None:
+                raise CalendarParseError(f"閉じていないセルがあります: {_decode(attrs[b'data-join-time'], encoding)}")
+            cell = content[td.end():cell_end]
+
+            for span in SPAN_TAG_RE.finditer(cell):
+                if span.group(1) is None:
+                    continue
+                classes = _decode(_parse_attrs(span.group(1)).get(b"class", b""), encoding).split()
+                if "icon" not in classes:
+                    continue
+                # 閉じていないspanはセルの終わりまで
+                span_end = _matching_end(SPAN_TAG_RE, cell, span.end())
+                body = cell[span.end():len(cell) if span_end is None else span_end]
+                # get_text(strip=True)と同じく、タグで区切られた断片ごとにstripしてつなぐ
+                status_text = "".join(_decode(part, encoding).strip() for part in TAG_RE.split(body))
+                if status_text != FULL_MARK:
+                    available_dates.append(_decode(attrs[b"data-join-time"], encoding))
+                break
+
+    except UnicodeDecodeError as e:
+        raise CalendarParseError(f"文字コードを解釈できません: {e}")
+
+    # タグの書き方が想定外で読み落としたセルがあれば（<td>として読めなかった出現も含む）、結果を信用しない
+    if cell_count != marker_count:
+        raise CalendarParseError(
+            f"data-join-timeのセル数が一致しません (解析 {cell_count} 件 / 出現 {marker_count} 件)"
+        )
+
+    logger.debug(f"空き日抽出: {facility_id} {len(available_dates)} 件")
+    return available_dates
+
+# カレンダー部分（最初から最後のdata-join-timeのセルまで）のハッシュ
+# ページの他の部分（トークンや時刻の表示など）が変わっても、空き状況が同じなら同じ値になる
+def calendar_fingerprint(content, encoding="utf-8"):
+    if isinstance(content, str):
+        content = content.encode(encoding)
+
+    start = content.find(JOIN_TIME_MARKER)
+    if start == -1:
+        return hashlib.sha256(content).hexdigest()
+    end = content.find(b"</td", content.rfind(JOIN_TIME_MARKER))
+    if end == -1:
+        end = len(content)
+    return hashlib.sha256(content[start:end]).hexdigest()
@@ -1,26 +1,137 @@
 # db_utils.py
 
 from datetime import datetime
+from contextlib import contextmanager
 from psycopg2.extras import RealDictCursor
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import psycopg2
+from logging_setup import log_summary
+from wish_conditions import conditions_from_row
+from wish_conditions import NO_CONDITIONS
+import metrics
 import os 
+import time
 import logging
+import threading
 
 # .envから環境変数を通す
 database_url = os.getenv('DATABASE_URL')
 
+# コネクションプール設定
+db_pool_min = int(os.getenv("DB_POOL_MIN", "1"))
+db_pool_max = int(os.getenv("DB_POOL_MAX", "5"))
+db_connect_timeout = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))  # 接続確立のタイムアウト（秒）
+db_health_check_interval = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))  # この秒数以上使っていない接続は貸出前に生存確認する
+
+# 一括処理で1回のexecute_valuesに詰める行数
+BATCH_PAGE_SIZE = 1000
+
+# 施設一覧のメモリキャッシュ設定　他のワーカーが施設を更新した場合に備え、この秒数ごとに読み直す
+facility_cache_ttl = float(os.getenv("FACILITY_CACHE_TTL", "600"))
+
+# 各関数の実行時間を db_query_seconds{function="関数名"} に記録する
+timed_query = metrics.DB_QUERY_SECONDS.timed()
+
 # logger 設定
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(db_pool_max)  # 満杯時にPoolErrorではなく空きを待つため
+_last_used = {}  # id(conn) -> 最後に返却された時刻
+_last_failure = 0.0  # 最後に接続断を検知した時刻　これより前の接続はすべて確認し直す
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+_facility_cache_lock = threading.Lock()
+_facility_cache = {
+    "version": 0,  # 内容が変わるたびに増える　描画結果のキャッシュキーに使う
+    "loaded_at": None,  # time.monotonic()　Noneなら次回読み直す
+    "items": [],  # get_items_from_db()と同じ名前順のリスト
+    "names": {}  # id -> name
+}
+
+# プロセス内で共有するコネクションプールを返す（初回呼び出し時に作成）
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    db_pool_min, db_pool_max, database_url,
+                    connect_timeout=db_connect_timeout
+                )
+                logger.info(f"[DBプール作成] min={db_pool_min}, max={db_pool_max}")
+    return _pool
+
+# 貸出前の生存確認　フェイルオーバー後の切れた接続を使わないため
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout(db_pool):
+    # 接続が全部死んでいても、プールの大きさ分入れ替えれば新しい接続にたどり着く
+    for _ in range(db_pool_max + 1):
+        conn = db_pool.getconn()
+        last_used = _last_used.get(id(conn))
+        needs_check = conn.closed or (
+            last_used is not None
+            and (time.monotonic() - last_used > db_health_check_interval or last_used < _last_failure)
+        )
+        if not needs_check or _is_healthy(conn):
+            return conn
+        logger.warning("[DBプール] 切断された接続を破棄して再接続します")
+        _last_used.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("有効なDB接続を取得できませんでした")
+
+# プールから接続を借りるコンテキストマネージャ
+# 正常終了でcommit、例外時はrollbackし、接続断なら接続を捨てて返却する
+@contextmanager
+def get_connection():
+    global _last_failure
+
+    with _pool_slots:
+        db_pool = get_pool()
+        conn = _checkout(db_pool)
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            _last_failure = time.monotonic()
+            raise
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            broken = broken or bool(conn.closed)
+            if broken:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            db_pool.putconn(conn, close=broken)
+
 # 初回起動時にfacilities,users,user_wishesテーブルを作成する
+@timed_query
 def create_tables(): # テーブル作成済なので呼ばれないが構造把握のために残す
     if not database_url:
         logger.error("DATABASE_URL環境変数が設定されていません")
-        return
+        return False
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 # facilitiesテーブルを作成
                 cursor.execute('''
@@ -46,69 +157,209 @@ def create_tables(): # テーブル作成済なので呼ばれないが構造把
                         FOREIGN KEY (facility_id) REFERENCES facilities(id)
                     );
                 """)
+                # facility_availabilityテーブルを作成（施設ごとの前回スキャン時の空き日）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS facility_availability (
+                        facility_id TEXT PRIMARY KEY,
+                        available_dates TEXT[] NOT NULL DEFAULT '{}',
+                        scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (facility_id) REFERENCES facilities(id)
+                    );
+                """)
+                # calendar_fingerprintsテーブルを作成（施設×月ごとの前回のカレンダーページの指紋と空き日）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS calendar_fingerprints (
+                        facility_id TEXT NOT NULL,
+                        month TEXT NOT NULL,
+                        content_hash TEXT NOT NULL,
+                        etag TEXT,
+                        last_modified TEXT,
+                        available_dates TEXT[] NOT NULL DEFAULT '{}',
+                        fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (facility_id, month),
+                        FOREIGN KEY (facility_id) REFERENCES facilities(id)
+                    );
+                """)
+                # scan_leasesテーブルを作成（複数プロセスのうち1つだけがスキャンするためのリース）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS scan_leases (
+                        name TEXT PRIMARY KEY,
+                        holder TEXT,
+                        expires_at TIMESTAMP,
+                        last_started_at TIMESTAMP,
+                        last_finished_at TIMESTAMP
+                    );
+                """)
+                # scan_budgetsテーブルを作成（its-kenpoへのリクエストの残り回数　全プロセスで共有し、止まっている間も補充する）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS scan_budgets (
+                        name TEXT PRIMARY KEY,
+                        tokens REAL NOT NULL,
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                # scan_jobsテーブルを作成（施設ごとのスキャン要求　複数のワーカーが取り合って処理する）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS scan_jobs (
+                        id BIGSERIAL PRIMARY KEY,
+                        facility_id TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        max_attempts INTEGER NOT NULL DEFAULT 3,
+                        run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        locked_by TEXT,
+                        locked_until TIMESTAMP,
+                        last_error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP,
+                        FOREIGN KEY (facility_id) REFERENCES facilities(id)
+                    );
+                """)
+                # webhook_eventsテーブルを作成（処理済みのwebhookEventId　LINEの再送を複数ワーカーで見分ける）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS webhook_events (
+                        event_id TEXT PRIMARY KEY,
+                        received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+                # 既存のテーブルへの変更を順に適用する
+                migrate_schema(cursor)
+        return True
                 
     except psycopg2.Error as e:
         logger.error(f"データベースエラー: {e}")
+        return False
         
     except Exception as e:
         logger.error(f"予期しないエラー: {e}")
+        return False
+
+# テーブルの作成・変更をプロセスで1回だけ行う　最初にDBを使う処理から呼ぶ
+# 起動時に呼ぶとDBの接続待ちの分だけ最初の応答が遅れるため、使う直前まで遅らせる
+# 失敗したときは次に呼ばれたときにやり直す
+def ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return True
+    with _schema_lock:
+        if not _schema_ready:
+            started = time.perf_counter()
+            _schema_ready = create_tables()
+            metrics.STARTUP_SECONDS.set(time.perf_counter() - started, phase="db_schema")
+            logger.info(f"[遅延初期化] DBスキーマ確認 {(time.perf_counter() - started) * 1000:.0f} ms, 結果={_schema_ready}")
+    return _schema_ready
+
+# 作成済みのテーブルに後から加えた変更　どれも何度実行しても結果が変わらないように書く
+SCHEMA_MIGRATIONS = [
+    # 施設ごとの希望者検索（get_wished_user、スキャン時の配信先取得）用　主キー(user_id, facility_id)は使えないため
+    "CREATE INDEX IF NOT EXISTS idx_user_wishes_facility_id ON user_wishes (facility_id)",
+    # 空き日が変わった頻度（スキャンごとの指数移動平均、0〜1）　スキャン間隔の調整に使う
+    "ALTER TABLE facility_availability ADD COLUMN IF NOT EXISTS change_rate REAL NOT NULL DEFAULT 0",
+    # 同じ施設の未処理のジョブは1件だけにする（スケジューラが何度積んでも重複しない）
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_scan_jobs_open_facility ON scan_jobs (facility_id) WHERE status IN ('pending', 'running')",
+    # ワーカーが次に処理するジョブを探す用
+    "CREATE INDEX IF NOT EXISTS idx_scan_jobs_claim ON scan_jobs (status, run_after)",
+    # 古いwebhookEventIdの掃除用
+    "CREATE INDEX IF NOT EXISTS idx_webhook_events_received_at ON webhook_events (received_at)",
+    # 希望ごとの通知条件（wish_conditions.py）　NULLは制限なし
+    "ALTER TABLE user_wishes ADD COLUMN IF NOT EXISTS date_from DATE",
+    "ALTER TABLE user_wishes ADD COLUMN IF NOT EXISTS date_to DATE",
+    "ALTER TABLE user_wishes ADD COLUMN IF NOT EXISTS weekdays SMALLINT",
+    "ALTER TABLE user_wishes ADD COLUMN IF NOT EXISTS min_nights SMALLINT NOT NULL DEFAULT 1",
+]
+
+def migrate_schema(cursor):
+    for statement in SCHEMA_MIGRATIONS:
+        cursor.execute(statement)
+    logger.info(f"[スキーマ移行] {len(SCHEMA_MIGRATIONS)} 件適用")
 
-# main.pyが起動するたびfacilitiesにスクレイピングし更新
+# main.pyが起動するたびfacilitiesにスクレイピングし更新　保存できたらTrue
+@timed_query
 def save_facilities(facilities):
     logger.info(f'保存対象の施設数:{len(facilities)}')
 
     if not database_url:
         logger.error("DATABASE_URL環境変数が設定されていません")
-        return
+        return False
+
+    # IDが取れなかった施設は保存できないので除き、同じIDは後のものを採用する（1文で同じ行を2回更新できないため）
+    rows = {}
+    for facility in facilities:
+        if not facility['id']:
+            logger.warning(f"IDがないため保存しません: {facility['name']}")
+            continue
+        rows[facility['id']] = facility['name']
+
+    if not rows:
+        return True
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                # 1回の一括upsertで新規追加と名称変更を反映する　変化のない行は更新しない
+                changed = execute_values(cursor, '''
+                    INSERT INTO facilities (id, name)
+                    VALUES %s
+                    ON CONFLICT(id) DO UPDATE
+                    SET name = EXCLUDED.name
+                    WHERE facilities.name IS DISTINCT FROM EXCLUDED.name
+                    RETURNING id, name, (xmax = 0) AS inserted
+                ''', list(rows.items()), fetch=True)
+
                 new_count = 0
-                skip_count = 0
-                
-                for facility in facilities:
-                    try:
-                        cursor.execute('''
-                            INSERT INTO facilities (id, name)
-                            VALUES (%s, %s)
-                            ON CONFLICT(id) DO NOTHING
-                        ''', (facility['id'], facility['name']))
-                        
-                        # 実際に挿入された行数を確認
-                        if cursor.rowcount > 0:
-                            new_count += 1
-                            logger.info(f"新規保存: {facility['name']} (ID={facility['id']})")
-                        else:
-                            skip_count += 1
-                            logger.info(f"既存のためスキップ: {facility['name']} (ID={facility['id']})")
-                            
-                    except psycopg2.Error as e:
-                        logger.error(f"保存失敗: {facility['id']} - {e}")
-                        continue
-
-                logger.info(f'施設情報保存完了 - 新規: {new_count}件, スキップ: {skip_count}件')
+                renamed_count = 0
+                for row in changed:
+                    if row['inserted']:
+                        new_count += 1
+                        logger.debug("新規保存: %s (ID=%s)", row['name'], row['id'])
+                    else:
+                        renamed_count += 1
+                        logger.debug("名称更新: %s (ID=%s)", row['name'], row['id'])
+
+                log_summary(logger, "施設情報保存完了", {"new": new_count, "renamed": renamed_count, "unchanged": len(rows) - len(changed)})
+                if changed:
+                    invalidate_facility_cache()
+                return True
     
     except psycopg2.Error as e:
         logger.error(f'DB接続エラー: {e}')
+        return False
     except Exception as e:
         logger.error(f'予期しないエラー: {e}')
+        return False
 
 # スクレイピング時に、希望者のいる施設のみ限定するためにuser_wishesを参照する
+@timed_query
 def fetch_wished_facilities():
+    return _fetch_wishes("", ())
+
+# 1ユーザーの希望施設を施設名順に返す（「解除」「空き確認」用）
+@timed_query
+def fetch_user_wished_facilities(user_id):
+    return _fetch_wishes("WHERE uw.user_id = %s ORDER BY f.name", (user_id,))
+
+# 指定した施設の希望者を返す（施設単位のスキャンの配信先用）
+@timed_query
+def fetch_wished_facilities_by_facility(facility_ids):
+    if not facility_ids:
+        return []
+    return _fetch_wishes("WHERE uw.facility_id = ANY(%s)", (list(facility_ids),))
+
+def _fetch_wishes(condition, params):
     if not database_url:
         logger.error("DATABASE_URL環境変数が設定されていません")
         return []
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 # user_wishesにある希望施設情報をfacilitiesと結合
                 cursor.execute('''
-                    SELECT uw.user_id, uw.facility_id, f.name As facility_name
+                    SELECT uw.user_id, uw.facility_id, f.name As facility_name, uw.created_at,
+                           uw.date_from, uw.date_to, uw.weekdays, uw.min_nights
                     FROM user_wishes uw
                     JOIN facilities f ON uw.facility_id = f.id
-                ''')
+                ''' + condition, params)
 
                 rows = cursor.fetchall()
                 logger.info(f"JOIN結果: {len(rows)} 件取得")
@@ -121,7 +372,9 @@ def fetch_wished_facilities():
                     {
                         "user_id": row["user_id"],
                         "facility_id": row["facility_id"],
-                        "facility_name": row["facility_name"]
+                        "facility_name": row["facility_name"],
+                        "created_at": row["created_at"],
+                        "conditions": conditions_from_row(row)
                     }
                     for row in rows
                 ]
@@ -134,21 +387,525 @@ def fetch_wished_facilities():
         logger.error(f"予期しないエラー: {e}")
         return []
     
+# 前回スキャン時の空き日スナップショットを施設IDごとに返す
+# 戻り値: {facility_id: {"available_dates": [...], "scanned_at": datetime, "age_seconds": 経過秒数}}
+@timed_query
+def fetch_availability_snapshots(facility_ids):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return {}
+
+    if not facility_ids:
+        return {}
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT facility_id, available_dates, scanned_at,
+                           EXTRACT(EPOCH FROM (LOCALTIMESTAMP - scanned_at)) AS age_seconds
+                    FROM facility_availability
+                    WHERE facility_id = ANY(%s)
+                """, (list(facility_ids),))
+
+                snapshots = {
+                    row["facility_id"]: {
+                        "available_dates": row["available_dates"],
+                        "scanned_at": row["scanned_at"],
+                        "age_seconds": float(row["age_seconds"])
+                    }
+                    for row in cursor.fetchall()
+                }
+                logger.info(f"[スナップショット取得] {len(snapshots)} 件")
+                return snapshots
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] fetch_availability_snapshots: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"[予期しないエラー] fetch_availability_snapshots: {e}")
+        return {}
+
+# 今回のスキャン結果でスナップショットを上書きする
+# snapshots: {facility_id: [空き日, ...]}
+@timed_query
+def save_availability_snapshots(snapshots):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    if not snapshots:
+        return
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO facility_availability (facility_id, available_dates)
+                    VALUES %s
+                    ON CONFLICT (facility_id) DO UPDATE
+                    SET available_dates = EXCLUDED.available_dates,
+                        scanned_at = CURRENT_TIMESTAMP,
+                        change_rate = facility_availability.change_rate * 0.7 + CASE
+                            WHEN facility_availability.available_dates IS DISTINCT FROM EXCLUDED.available_dates THEN 0.3
+                            ELSE 0
+                        END
+                """, [(facility_id, list(dates)) for facility_id, dates in snapshots.items()])
+                conn.commit()
+                logger.info(f"[スナップショット保存] {len(snapshots)} 件")
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] save_availability_snapshots: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] save_availability_snapshots: {e}")
+
+# 施設×月ごとの前回のカレンダーページの指紋を取得する
+# 戻り値: {facility_id: {"YYYY-MM": {"content_hash", "etag", "last_modified", "available_dates"}}}
+@timed_query
+def fetch_calendar_fingerprints(facility_ids):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return {}
+
+    if not facility_ids:
+        return {}
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT facility_id, month, content_hash, etag, last_modified, available_dates
+                    FROM calendar_fingerprints
+                    WHERE facility_id = ANY(%s)
+                """, (list(facility_ids),))
+
+                fingerprints = {}
+                for row in cursor.fetchall():
+                    fingerprints.setdefault(row["facility_id"], {})[row["month"]] = {
+                        "content_hash": row["content_hash"],
+                        "etag": row["etag"],
+                        "last_modified": row["last_modified"],
+                        "available_dates": row["available_dates"]
+                    }
+                return fingerprints
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] fetch_calendar_fingerprints: {e}")
+        return {}
+    except Exception as e:
+        logger.error(f"[予期しないエラー] fetch_calendar_fingerprints: {e}")
+        return {}
+
+# 変わった指紋だけを保存し、過ぎた月の指紋を消す
+# fingerprints: {facility_id: {"YYYY-MM": {...}}}
+@timed_query
+def save_calendar_fingerprints(fingerprints, current_month):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    rows = [
+        (facility_id, month, fingerprint["content_hash"], fingerprint["etag"],
+         fingerprint["last_modified"], list(fingerprint["available_dates"]))
+        for facility_id, months in fingerprints.items()
+        for month, fingerprint in months.items()
+    ]
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                if rows:
+                    execute_values(cursor, """
+                        INSERT INTO calendar_fingerprints
+                            (facility_id, month, content_hash, etag, last_modified, available_dates)
+                        VALUES %s
+                        ON CONFLICT (facility_id, month) DO UPDATE
+                        SET content_hash = EXCLUDED.content_hash,
+                            etag = EXCLUDED.etag,
+                            last_modified = EXCLUDED.last_modified,
+                            available_dates = EXCLUDED.available_dates,
+                            fetched_at = CURRENT_TIMESTAMP
+                    """, rows)
+                cursor.execute("DELETE FROM calendar_fingerprints WHERE month < %s", (current_month,))
+                conn.commit()
+                logger.info(f"[指紋保存] {len(rows)} 件")
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] save_calendar_fingerprints: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] save_calendar_fingerprints: {e}")
+
+# 希望者のいる施設ごとに、スキャン間隔を決めるための情報を取得する
+# 一度もスキャンしていない施設は available_dates が空、age_seconds が None
+# conditions は希望者の通知条件（重複を除いたもの）　取りに行く月の計算に使う
+@timed_query
+def fetch_scan_candidates():
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return []
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    SELECT uw.facility_id, COUNT(*) AS subscribers,
+                           jsonb_agg(DISTINCT jsonb_build_object(
+                               'date_from', uw.date_from, 'date_to', uw.date_to,
+                               'weekdays', uw.weekdays, 'min_nights', uw.min_nights
+                           )) AS conditions,
+                           COALESCE(fa.available_dates, '{}') AS available_dates,
+                           COALESCE(fa.change_rate, 0) AS change_rate,
+                           EXTRACT(EPOCH FROM (LOCALTIMESTAMP - fa.scanned_at)) AS age_seconds
+                    FROM user_wishes uw
+                    JOIN facilities f ON uw.facility_id = f.id
+                    LEFT JOIN facility_availability fa ON fa.facility_id = uw.facility_id
+                    GROUP BY uw.facility_id, fa.available_dates, fa.change_rate, fa.scanned_at
+                """)
+
+                return [
+                    {
+                        "facility_id": row["facility_id"],
+                        "subscribers": row["subscribers"],
+                        "conditions": [conditions_from_row(conditions) for conditions in row["conditions"]],
+                        "available_dates": row["available_dates"],
+                        "change_rate": float(row["change_rate"]),
+                        "age_seconds": None if row["age_seconds"] is None else float(row["age_seconds"])
+                    }
+                    for row in cursor.fetchall()
+                ]
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] fetch_scan_candidates: {e}")
+        return []
+    except Exception as e:
+        logger.error(f"[予期しないエラー] fetch_scan_candidates: {e}")
+        return []
+
+# スキャンのリースを取得する　取得できたらTrue
+# 他のプロセスが有効なリースを持っているか、前回の終了からmin_interval秒たっていなければFalse
+@timed_query
+def acquire_scan_lease(name, holder, ttl_seconds, min_interval_seconds):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return False
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                # 競合時は行ロックを取ってからWHEREを評価し直すので、同時に取りに来ても1つしか成功しない
+                cursor.execute("""
+                    INSERT INTO scan_leases (name, holder, expires_at, last_started_at)
+                    VALUES (%s, %s, LOCALTIMESTAMP + make_interval(secs => %s), LOCALTIMESTAMP)
+                    ON CONFLICT (name) DO UPDATE
+                    SET holder = EXCLUDED.holder,
+                        expires_at = EXCLUDED.expires_at,
+                        last_started_at = EXCLUDED.last_started_at
+                    WHERE scan_leases.expires_at < LOCALTIMESTAMP
+                      AND (scan_leases.last_finished_at IS NULL
+                           OR scan_leases.last_finished_at < LOCALTIMESTAMP - make_interval(secs => %s))
+                    RETURNING holder
+                """, (name, holder, ttl_seconds, min_interval_seconds))
+                acquired = cursor.fetchone() is not None
+                logger.info(f"[リース取得] name={name}, holder={holder}, 結果={acquired}")
+                return acquired
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] acquire_scan_lease: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"[予期しないエラー] acquire_scan_lease: {e}")
+        return False
+
+# スキャンが長引いたときにリースの期限を延ばす　自分が持っていなければFalse
+@timed_query
+def renew_scan_lease(name, holder, ttl_seconds):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return False
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_leases
+                    SET expires_at = LOCALTIMESTAMP + make_interval(secs => %s)
+                    WHERE name = %s AND holder = %s
+                """, (ttl_seconds, name, holder))
+                return cursor.rowcount > 0
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] renew_scan_lease: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"[予期しないエラー] renew_scan_lease: {e}")
+        return False
+
+# スキャン終了時にリースを手放し、終了時刻を記録する
+@timed_query
+def release_scan_lease(name, holder):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_leases
+                    SET expires_at = LOCALTIMESTAMP, last_finished_at = LOCALTIMESTAMP
+                    WHERE name = %s AND holder = %s
+                """, (name, holder))
+                logger.info(f"[リース解放] name={name}, holder={holder}")
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] release_scan_lease: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] release_scan_lease: {e}")
+
+# リクエストの残り回数を、前回からの経過時間に応じて補充（1時間あたりhourly件、最大capacity件）してから返す
+# 初回は満タンから始める　DBエラーのときはNone
+@timed_query
+def refill_scan_budget(name, hourly, capacity):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return None
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                # 行ロックを取って更新するので、複数のプロセスが同時に補充しても二重に増えない
+                cursor.execute("""
+                    INSERT INTO scan_budgets (name, tokens, updated_at)
+                    VALUES (%s, %s, LOCALTIMESTAMP)
+                    ON CONFLICT (name) DO UPDATE
+                    SET tokens = LEAST(
+                            EXCLUDED.tokens,
+                            scan_budgets.tokens + %s * EXTRACT(EPOCH FROM LOCALTIMESTAMP - scan_budgets.updated_at) / 3600
+                        ),
+                        updated_at = LOCALTIMESTAMP
+                    RETURNING tokens
+                """, (name, capacity, hourly))
+                return cursor.fetchone()[0]
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] refill_scan_budget: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[予期しないエラー] refill_scan_budget: {e}")
+        return None
+
+# 使ったリクエスト数を残り回数から引く　使いすぎた分はマイナスのまま残し、次の補充で返す
+@timed_query
+def spend_scan_budget(name, request_count):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_budgets SET tokens = tokens - %s WHERE name = %s
+                """, (request_count, name))
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] spend_scan_budget: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] spend_scan_budget: {e}")
+
+# 施設ごとのスキャンジョブを積む　すでに未処理のジョブがある施設は積まない
+# 戻り値: ジョブを積んだ施設IDのリスト　DBエラーのときはNone
+@timed_query
+def enqueue_scan_jobs(facility_ids, max_attempts=3):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return None
+
+    facility_ids = list(dict.fromkeys(facility_ids))
+    if not facility_ids:
+        return []
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                inserted = execute_values(cursor, """
+                    INSERT INTO scan_jobs (facility_id, max_attempts)
+                    VALUES %s
+                    ON CONFLICT (facility_id) WHERE status IN ('pending', 'running') DO NOTHING
+                    RETURNING facility_id
+                """, [(facility_id, max_attempts) for facility_id in facility_ids], page_size=BATCH_PAGE_SIZE, fetch=True)
+                conn.commit()
+                logger.info(f"[ジョブ投入] {len(facility_ids)} 件中 {len(inserted)} 件を追加")
+                return [row[0] for row in inserted]
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] enqueue_scan_jobs: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[予期しないエラー] enqueue_scan_jobs: {e}")
+        return None
+
+# 処理できるジョブを最大limit件取って自分のものにする
+# 他のワーカーが取ったジョブは SKIP LOCKED で飛ばすので、同時に取りに来ても同じジョブを取らない
+# 期限（visibility_timeout秒）を過ぎても終わっていないジョブは、落ちたワーカーのものとみなして取り直す
+# 戻り値: [{"id", "facility_id", "attempts", "max_attempts"}, ...]
+@timed_query
+def claim_scan_jobs(worker_id, limit, visibility_timeout):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return []
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                # 試行回数を使い切ったまま期限切れになったジョブは失敗にする
+                cursor.execute("""
+                    UPDATE scan_jobs
+                    SET status = 'failed', finished_at = LOCALTIMESTAMP,
+                        last_error = COALESCE(last_error, 'visibility timeout')
+                    WHERE status = 'running' AND locked_until < LOCALTIMESTAMP AND attempts >= max_attempts
+                """)
+                cursor.execute("""
+                    UPDATE scan_jobs
+                    SET status = 'running',
+                        attempts = attempts + 1,
+                        locked_by = %s,
+                        locked_until = LOCALTIMESTAMP + make_interval(secs => %s)
+                    WHERE id IN (
+                        SELECT id FROM scan_jobs
+                        WHERE (status = 'pending' AND run_after <= LOCALTIMESTAMP)
+                           OR (status = 'running' AND locked_until < LOCALTIMESTAMP)
+                        ORDER BY run_after, id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, facility_id, attempts, max_attempts
+                """, (worker_id, visibility_timeout, limit))
+                jobs = [dict(row) for row in cursor.fetchall()]
+                conn.commit()
+                if jobs:
+                    logger.info(f"[ジョブ取得] worker={worker_id} {len(jobs)} 件")
+                return jobs
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] claim_scan_jobs: {e}")
+        return []
+    except Exception as e:
+        logger.error(f"[予期しないエラー] claim_scan_jobs: {e}")
+        return []
+
+# 処理中のジョブの期限を延ばす　戻り値: 延ばせた件数（他のワーカーに取り直されたジョブは数えない）
+@timed_query
+def extend_scan_jobs(job_ids, worker_id, visibility_timeout):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_jobs
+                    SET locked_until = LOCALTIMESTAMP + make_interval(secs => %s)
+                    WHERE id = ANY(%s) AND status = 'running' AND locked_by = %s
+                """, (visibility_timeout, list(job_ids), worker_id))
+                return cursor.rowcount
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] extend_scan_jobs: {e}")
+        return 0
+    except Exception as e:
+        logger.error(f"[予期しないエラー] extend_scan_jobs: {e}")
+        return 0
+
+# 終わったジョブを完了にする
+@timed_query
+def complete_scan_jobs(job_ids, worker_id):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_jobs
+                    SET status = 'done', finished_at = LOCALTIMESTAMP, locked_until = NULL
+                    WHERE id = ANY(%s) AND status = 'running' AND locked_by = %s
+                """, (list(job_ids), worker_id))
+                logger.info(f"[ジョブ完了] worker={worker_id} {cursor.rowcount} 件")
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] complete_scan_jobs: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] complete_scan_jobs: {e}")
+
+# 失敗したジョブを、試行回数が残っていれば retry_delay × 2^(試行回数-1) 秒後に再実行、使い切っていれば失敗にする
+@timed_query
+def fail_scan_jobs(job_ids, worker_id, error, retry_delay):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE scan_jobs
+                    SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END,
+                        run_after = LOCALTIMESTAMP + make_interval(secs => %s * power(2, attempts - 1)),
+                        finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE LOCALTIMESTAMP END,
+                        locked_by = NULL,
+                        locked_until = NULL,
+                        last_error = %s
+                    WHERE id = ANY(%s) AND status = 'running' AND locked_by = %s
+                """, (retry_delay, str(error)[:1000], list(job_ids), worker_id))
+                logger.warning(f"[ジョブ失敗] worker={worker_id} {cursor.rowcount} 件: {error}")
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] fail_scan_jobs: {e}")
+    except Exception as e:
+        logger.error(f"[予期しないエラー] fail_scan_jobs: {e}")
+
+# 終わってから older_than_seconds 秒たった完了・失敗のジョブを消す　戻り値: 消した件数
+@timed_query
+def purge_scan_jobs(older_than_seconds):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM scan_jobs
+                    WHERE status IN ('done', 'failed')
+                      AND finished_at < LOCALTIMESTAMP - make_interval(secs => %s)
+                """, (older_than_seconds,))
+                return cursor.rowcount
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] purge_scan_jobs: {e}")
+        return 0
+    except Exception as e:
+        logger.error(f"[予期しないエラー] purge_scan_jobs: {e}")
+        return 0
+
 # 登録解除時に使用するデータをとってくる
 def fetch_user_wished_facilities_for_cancel(user_id):
     logger.info(f"[解除取得開始] user_id={user_id} の希望施設を取得します")
 
-    all = fetch_wished_facilities()
-    user_facilities = [item for item in all if item['user_id'] == user_id]
+    user_facilities = fetch_user_wished_facilities(user_id)
 
     logger.info(f"[解除対象取得完了] user_id={user_id}, 件数={len(user_facilities)}")
     for item in user_facilities:
-        logger.debug(f"解除候補施設: {item['facility_name']} (ID={item['facility_id']})")
+        logger.debug("解除候補施設: %s (ID=%s)", item['facility_name'], item['facility_id'])
 
     return user_facilities
 
 
 # ユーザーがボットをフォローしたときそのIDをusersテーブルに保存
+@timed_query
 def save_followed_userid(userid):
     logger.info(f"保存対象のユーザID:{userid}")
     
@@ -157,7 +914,7 @@ def save_followed_userid(userid):
         return
     
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute('''
                     INSERT INTO users (user_id)
@@ -176,6 +933,7 @@ def save_followed_userid(userid):
         logger.error(f"予期しないエラー: {e}")
 
 # DBから施設データを取得
+@timed_query
 def get_items_from_db():
     
     if not database_url:
@@ -183,7 +941,7 @@ def get_items_from_db():
         return []
 
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute('''
                     SELECT id, name
@@ -201,7 +959,48 @@ def get_items_from_db():
         logger.error(f"予期しないエラー: {e}")
         return []
 
+# 施設一覧をメモリキャッシュから返す　戻り値: (version, 名前順の施設リスト)
+# webhookのたびにfacilitiesテーブル全体を読まないため
+def get_facility_catalog():
+    with _facility_cache_lock:
+        cache = _facility_cache
+        if cache["loaded_at"] is not None and time.monotonic() - cache["loaded_at"] < facility_cache_ttl:
+            metrics.CACHE_HITS.inc(cache="facility_names")
+            return cache["version"], cache["items"]
+        metrics.CACHE_MISSES.inc(cache="facility_names")
+
+        items = get_items_from_db()
+        # 取得に失敗した（空の）ときは手元のキャッシュを使い、次回また読み直す
+        if not items:
+            return cache["version"], cache["items"]
+
+        items = [{"id": item["id"], "name": item["name"]} for item in items]
+        if items != cache["items"]:
+            cache["version"] += 1
+            cache["items"] = items
+            cache["names"] = {item["id"]: item["name"] for item in items}
+            logger.info(f"[施設キャッシュ更新] version={cache['version']}, {len(items)} 件")
+        cache["loaded_at"] = time.monotonic()
+        return cache["version"], cache["items"]
+
+# 施設IDから施設名を引く　見つからなければNone
+def get_facility_name(facility_id):
+    get_facility_catalog()
+    name = _facility_cache["names"].get(facility_id)
+    if name is None:
+        # 他のワーカーが追加した直後の施設かもしれないので1回だけ読み直す
+        invalidate_facility_cache()
+        get_facility_catalog()
+        name = _facility_cache["names"].get(facility_id)
+    return name
+
+# 施設一覧が変わったときに呼び、次回のget_facility_catalogで読み直させる
+def invalidate_facility_cache():
+    with _facility_cache_lock:
+        _facility_cache["loaded_at"] = None
+
 # ユーザー希望する施設と日程を入力したときそれをuser_wishesにIDと紐づけて保存
+@timed_query
 def register_user_selection(user_id, facility_id):
 
     logger.info(f"[登録処理開始] user_id={user_id}, facility_id={facility_id}")
@@ -211,7 +1010,7 @@ def register_user_selection(user_id, facility_id):
         return
 
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute("""
                     INSERT INTO user_wishes (user_id, facility_id)
@@ -229,6 +1028,7 @@ def register_user_selection(user_id, facility_id):
         logger.error(f"[予期しないエラー] user_id={user_id}, facility_id={facility_id} - 内容: {e}")
 
 # 施設の空きが検知されたら対象の施設のIDを受け取って希望者のIDを返す
+@timed_query
 def get_wished_user(facility_id):
 
     logger.info(f"[希望者検索開始] facility_id={facility_id}")
@@ -238,7 +1038,7 @@ def get_wished_user(facility_id):
         return []
 
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute("""
                     SELECT user_id
@@ -258,6 +1058,7 @@ def get_wished_user(facility_id):
         return []
 
 # userのデータをusers、user_wishesから消す
+@timed_query
 def remove_user_from_db(user_id):
 
     logger.info(f"[削除開始] 対象ユーザーID: {user_id}")
@@ -267,7 +1068,7 @@ def remove_user_from_db(user_id):
         return
 
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 # user_wishes から先に削除（外部キー制約がある場合を考慮）
                 cursor.execute("DELETE FROM user_wishes WHERE user_id = %s", (user_id,))
@@ -282,9 +1083,10 @@ def remove_user_from_db(user_id):
         logger.error(f"[予期しないエラー] 削除処理失敗: user_id={user_id} - 内容: {e}")
 
 #　施設個別の登録解除関数
+@timed_query
 def cancell_user_selection(user_id, facility_id):
     try:
-        with psycopg2.connect(database_url) as conn:
+        with get_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("""
                     DELETE FROM user_wishes
@@ -295,3 +1097,223 @@ def cancell_user_selection(user_id, facility_id):
     except Exception as e:
         logger.error(f"[解除失敗] user_id={user_id}, facility_id={facility_id} - {e}")
 
+# 希望1件の通知条件（wish_conditions.py の形）を保存する　保存できたらTrue
+# 条件を変えた希望は登録し直したものとして扱い（created_atを更新）、次のスキャンで新しい条件に合う空きをすべて送る
+@timed_query
+def update_wish_conditions(user_id, facility_id, conditions):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return False
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE user_wishes
+                    SET date_from = %s, date_to = %s, weekdays = %s, min_nights = %s,
+                        created_at = CURRENT_TIMESTAMP
+                    WHERE user_id = %s AND facility_id = %s
+                """, (
+                    conditions["date_from"], conditions["date_to"], conditions["weekdays"], conditions["min_nights"],
+                    user_id, facility_id
+                ))
+                updated = cursor.rowcount > 0
+                conn.commit()
+                logger.info(f"[条件保存] user_id={user_id}, facility_id={facility_id}, 結果={updated}")
+                return updated
+
+    except psycopg2.Error as e:
+        logger.error(f"[条件保存失敗] user_id={user_id}, facility_id={facility_id} - DBエラー: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"[条件保存失敗] user_id={user_id}, facility_id={facility_id} - {e}")
+        return False
+
+
+# ユーザーIDをまとめてusersに保存する（1トランザクション）
+# 戻り値: 新しく追加した件数　DBエラーのときはNone
+@timed_query
+def register_users(user_ids):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return None
+
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                inserted = execute_values(cursor, """
+                    INSERT INTO users (user_id)
+                    VALUES %s
+                    ON CONFLICT (user_id) DO NOTHING
+                    RETURNING 1
+                """, [(user_id,) for user_id in user_ids], page_size=BATCH_PAGE_SIZE, fetch=True)
+                conn.commit()
+                logger.info(f"[一括ユーザー登録] {len(user_ids)} 件中 {len(inserted)} 件を追加")
+                return len(inserted)
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] register_users: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[予期しないエラー] register_users: {e}")
+        return None
+
+# (user_id, facility_id[, created_at]) をまとめてuser_wishesに登録する（1トランザクション）
+# usersにないユーザーは先に追加し、facilitiesにない施設の行は読み飛ばす
+# created_atを省略した行（またはNone）は登録時刻になる　4つ目に通知条件（wish_conditions.py の形）を渡せる
+# 戻り値: 新しく登録した件数　DBエラーのときはNone
+@timed_query
+def register_user_selections(selections):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return None
+
+    rows = {}
+    for selection in selections:
+        user_id, facility_id = selection[0], selection[1]
+        created_at = selection[2] if len(selection) > 2 else None
+        conditions = (selection[3] if len(selection) > 3 else None) or NO_CONDITIONS
+        rows[(user_id, facility_id)] = (
+            created_at, conditions["date_from"], conditions["date_to"], conditions["weekdays"], conditions["min_nights"]
+        )
+    if not rows:
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO users (user_id)
+                    VALUES %s
+                    ON CONFLICT (user_id) DO NOTHING
+                """, [(user_id,) for user_id in dict.fromkeys(user_id for user_id, _ in rows)], page_size=BATCH_PAGE_SIZE)
+
+                inserted = execute_values(cursor, """
+                    INSERT INTO user_wishes (user_id, facility_id, created_at, date_from, date_to, weekdays, min_nights)
+                    SELECT v.user_id, v.facility_id, COALESCE(v.created_at, CURRENT_TIMESTAMP),
+                           v.date_from, v.date_to, v.weekdays, COALESCE(v.min_nights, 1)
+                    FROM (VALUES %s) AS v (user_id, facility_id, created_at, date_from, date_to, weekdays, min_nights)
+                    JOIN facilities f ON f.id = v.facility_id
+                    ON CONFLICT (user_id, facility_id) DO NOTHING
+                    RETURNING 1
+                """, [(user_id, facility_id) + values for (user_id, facility_id), values in rows.items()],
+                    template="(%s, %s, %s::timestamp, %s::date, %s::date, %s::smallint, %s::smallint)",
+                    page_size=BATCH_PAGE_SIZE, fetch=True)
+                conn.commit()
+                logger.info(f"[一括登録] {len(rows)} 件中 {len(inserted)} 件を登録")
+                return len(inserted)
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] register_user_selections: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[予期しないエラー] register_user_selections: {e}")
+        return None
+
+# (user_id, facility_id) をまとめてuser_wishesから削除する（1トランザクション）
+# 戻り値: 削除した件数　DBエラーのときはNone
+@timed_query
+def cancel_user_selections(selections):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return None
+
+    pairs = list(dict.fromkeys((selection[0], selection[1]) for selection in selections))
+    if not pairs:
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                deleted = execute_values(cursor, """
+                    DELETE FROM user_wishes uw
+                    USING (VALUES %s) AS v (user_id, facility_id)
+                    WHERE uw.user_id = v.user_id AND uw.facility_id = v.facility_id
+                    RETURNING 1
+                """, pairs, page_size=BATCH_PAGE_SIZE, fetch=True)
+                conn.commit()
+                logger.info(f"[一括解除] {len(pairs)} 件中 {len(deleted)} 件を解除")
+                return len(deleted)
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] cancel_user_selections: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[予期しないエラー] cancel_user_selections: {e}")
+        return None
+
+# 書き出しに使うクエリ　テーブル名を外から受け取ってSQLに埋め込まないよう、ここに並べる
+EXPORT_QUERIES = {
+    "users": "SELECT user_id FROM users ORDER BY user_id",
+    "user_wishes": """
+        SELECT user_id, facility_id, created_at, date_from, date_to, weekdays, min_nights
+        FROM user_wishes ORDER BY user_id, facility_id
+    """
+}
+
+# users / user_wishes の全行を、サーバー側カーソルでbatch_size件ずつ読みながら1行ずつ返す
+# 件数が多くてもメモリに全件を載せない　DBエラーは呼び出し元に送出する
+def iter_export_rows(table, batch_size=BATCH_PAGE_SIZE):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return
+
+    with get_connection() as conn:
+        with conn.cursor(name=f"export_{table}", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(EXPORT_QUERIES[table])
+            for row in cursor:
+                yield dict(row)
+
+# webhookEventIdを処理済みとして記録する　初めてならTrue、他のワーカーがすでに記録していればFalse
+# DBに問題があるときは取りこぼさないようTrue（処理する）を返す
+@timed_query
+def claim_webhook_event(event_id):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return True
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO webhook_events (event_id)
+                    VALUES (%s)
+                    ON CONFLICT (event_id) DO NOTHING
+                    RETURNING 1
+                """, (event_id,))
+                return cursor.fetchone() is not None
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] claim_webhook_event: {e}")
+        return True
+    except Exception as e:
+        logger.error(f"[予期しないエラー] claim_webhook_event: {e}")
+        return True
+
+# older_than_seconds 秒より前に記録したwebhookEventIdを消す　戻り値: 消した件数
+@timed_query
+def purge_webhook_events(older_than_seconds):
+    if not database_url:
+        logger.error("DATABASE_URL環境変数が設定されていません")
+        return 0
+
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM webhook_events
+                    WHERE received_at < LOCALTIMESTAMP - make_interval(secs => %s)
+                """, (older_than_seconds,))
+                return cursor.rowcount
+
+    except psycopg2.Error as e:
+        logger.error(f"[DBエラー] purge_webhook_events: {e}")
+        return 0
+    except Exception as e:
+        logger.error(f"[予期しないエラー] purge_webhook_events: {e}")
+        return 0
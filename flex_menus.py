@@ -0,0 +1,150 @@
+# flex_menus.py
+
+from linebot.models import SendMessage
+import threading
+
+# 施設の選択・解除メニュー（Flexのカルーセル）
+# 施設一覧の版（db_utils.get_facility_catalog の version）ごとに1回だけ組み立てて覚えておき、
+# 送るときはユーザーの登録済み施設の印だけを差し替える
+
+BUTTONS_PER_BUBBLE = 10  # 1枚のバブルに並べる施設数
+BUBBLES_PER_PAGE = 12  # LINEのカルーセルに入るバブルの上限
+REGISTERED_MARK = "✓ "
+
+SELECT_ITEM_PREFIX = "select_item_"
+SELECT_PAGE_PREFIX = "select_page_"
+CANCEL_ITEM_PREFIX = "cancel_item_"
+CANCEL_PAGE_PREFIX = "cancel_page_"
+
+_menu_lock = threading.Lock()
+_menu_cache = {"version": None, "menu": None}
+
+# 組み立て済みのJSONをそのまま送るメッセージ　FlexSendMessageのようにオブジェクトへの変換をしない
+class PrebuiltFlexMessage(SendMessage):
+
+    def __init__(self, json_dict):
+        self._json_dict = json_dict
+
+    def as_json_dict(self):
+        return self._json_dict
+
+def _button(label, data, style, color=None):
+    button = {
+        "type": "button",
+        "action": {"type": "postback", "label": label[:40], "data": data},  # ラベルは40文字まで
+        "style": style
+    }
+    if color:
+        button["color"] = color
+    return button
+
+def _bubble(title, buttons, next_page_data=None):
+    bubble = {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [{"type": "text", "text": title, "weight": "bold", "size": "lg", "wrap": True}] + buttons
+        }
+    }
+    if next_page_data:
+        bubble["footer"] = {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [_button("次のページ ▶", next_page_data, "link")]
+        }
+    return bubble
+
+# ボタンの列をバブル・ページに分ける　戻り値: [[バブル, ...], ...]（ページごと）
+def _paginate(title, buttons, page_prefix):
+    chunks = [buttons[i:i + BUTTONS_PER_BUBBLE] for i in range(0, len(buttons), BUTTONS_PER_BUBBLE)] or [[]]
+    page_count = (len(chunks) + BUBBLES_PER_PAGE - 1) // BUBBLES_PER_PAGE
+
+    pages = []
+    for page in range(page_count):
+        page_chunks = chunks[page * BUBBLES_PER_PAGE:(page + 1) * BUBBLES_PER_PAGE]
+        page_title = title if page_count == 1 else f"{title}（{page + 1}/{page_count}）"
+        bubbles = [_bubble(page_title, chunk) for chunk in page_chunks]
+        if page + 1 < page_count:
+            bubbles[-1] = _bubble(page_title, page_chunks[-1], f"{page_prefix}{page + 1}")
+        pages.append(bubbles)
+    return pages
+
+# 施設一覧の版ごとのメニューの部品
+#   selection_pages: 選択メニューのページ（印なし）
+#   positions: facility_id -> (ページ, バブル, ボタンの位置)
+#   marked_buttons: facility_id -> 登録済みの印をつけたボタン
+#   cancel_buttons: facility_id -> 解除ボタン
+def _build_menu(items):
+    buttons = [_button(item["name"], f"{SELECT_ITEM_PREFIX}{item['id']}", "secondary") for item in items]
+    positions = {}
+    for index, item in enumerate(items):
+        bubble_index, button_index = divmod(index, BUTTONS_PER_BUBBLE)
+        page, bubble_index = divmod(bubble_index, BUBBLES_PER_PAGE)
+        positions[item["id"]] = (page, bubble_index, button_index + 1)  # 先頭は見出しのテキスト
+
+    return {
+        "selection_pages": _paginate("希望の施設を選択してください", buttons, SELECT_PAGE_PREFIX),
+        "positions": positions,
+        "marked_buttons": {
+            item["id"]: _button(f"{REGISTERED_MARK}{item['name']}", f"{SELECT_ITEM_PREFIX}{item['id']}", "primary")
+            for item in items
+        },
+        "cancel_buttons": {item["id"]: _cancel_button(item["id"], item["name"]) for item in items}
+    }
+
+def _cancel_button(facility_id, facility_name):
+    return _button(facility_name, f"{CANCEL_ITEM_PREFIX}{facility_id}", "primary", "#FF6666")
+
+def _get_menu(version, items):
+    with _menu_lock:
+        if _menu_cache["version"] != version:
+            _menu_cache.update({"version": version, "menu": _build_menu(items)})
+        return _menu_cache["menu"]
+
+def _carousel(alt_text, bubbles):
+    return PrebuiltFlexMessage({
+        "type": "flex",
+        "altText": alt_text,
+        "contents": {"type": "carousel", "contents": bubbles}
+    })
+
+# 施設選択メニューの1ページ　registered_ids の施設には登録済みの印をつける
+# 組み立て済みのページは共有しているので、印をつけるバブルだけを複製して差し替える
+def selection_message(version, items, registered_ids=(), page=0):
+    menu = _get_menu(version, items)
+    pages = menu["selection_pages"]
+    page = min(max(page, 0), len(pages) - 1)
+
+    bubbles = list(pages[page])
+    for facility_id in registered_ids:
+        position = menu["positions"].get(facility_id)
+        if position is None or position[0] != page:
+            continue
+        _, bubble_index, button_index = position
+        bubble = bubbles[bubble_index]
+        if bubble is pages[page][bubble_index]:
+            bubble = dict(bubble, body=dict(bubble["body"], contents=list(bubble["body"]["contents"])))
+            bubbles[bubble_index] = bubble
+        bubble["body"]["contents"][button_index] = menu["marked_buttons"][facility_id]
+
+    return _carousel("希望の施設を選択してください", bubbles)
+
+# 登録解除メニューの1ページ　解除ボタンは施設一覧の版ごとに作ったものを使いまわす
+def cancel_message(version, items, wished_facilities, page=0):
+    menu = _get_menu(version, items)
+    buttons = [
+        menu["cancel_buttons"].get(item["facility_id"]) or _cancel_button(item["facility_id"], item["facility_name"])
+        for item in wished_facilities
+    ]
+    pages = _paginate("登録解除する施設を選んでください", buttons, CANCEL_PAGE_PREFIX)
+    page = min(max(page, 0), len(pages) - 1)
+    return _carousel("登録解除する施設を選択してください", pages[page])
+
+# "select_page_2" → 2　ページ指定のpostbackでなければNone
+def parse_page(data, prefix):
+    if not data.startswith(prefix):
+        return None
+    page = data[len(prefix):]
+    return int(page) if page.isdigit() else 0
@@ -1,120 +1,244 @@
 #line_bot_server.py
 
-from flask import Flask, request, jsonify
+import time
+_process_started = time.perf_counter()  # 起動時間の計測用（ここから先のimportを含める）
+
+from flask import Flask, Blueprint, request, jsonify, Response
 from dotenv import load_dotenv
-from main import main
-from linebot import LineBotApi, WebhookHandler
+from linebot import LineBotApi, WebhookParser
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage,
-    FlexSendMessage, PostbackEvent, FollowEvent, UnfollowEvent
+    PostbackEvent, FollowEvent, UnfollowEvent
 )
 from linebot.exceptions import InvalidSignatureError
-from scraper import scrape_avl_from_calender
 from db_utils import (
-    get_items_from_db, save_followed_userid,
-    register_user_selection,fetch_wished_facilities,
+    ensure_schema, claim_webhook_event, purge_webhook_events,
+    get_facility_catalog, get_facility_name, save_followed_userid,
+    register_user_selection,fetch_availability_snapshots,
     remove_user_from_db,cancell_user_selection,
-    fetch_user_wished_facilities_for_cancel
+    fetch_user_wished_facilities_for_cancel, fetch_user_wished_facilities,
+    update_wish_conditions
 )
-from datetime import datetime, timedelta
-import threading
+from webhook_queue import EventWorkerPool
+from webhook_dedup import RecentEventIds
+from message_renderer import pack_texts
+from wish_conditions import NO_CONDITIONS, parse_conditions, format_conditions, filter_dates, needed_months
+from logging_setup import setup_logging
+from flex_menus import selection_message, cancel_message, parse_page, SELECT_PAGE_PREFIX, CANCEL_PAGE_PREFIX
+import metrics
+from datetime import datetime
+import atexit
 import os
 import logging
 import threading
-import time
-
 
-# Flask アプリ作成
-app = Flask(__name__)
+# ルートはBlueprintにまとめ、create_app()でアプリに登録する
+bot = Blueprint("bot", __name__)
 
 # ログ設定
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 # LINE Bot 認証情報
 load_dotenv()
 channel_access_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 channel_secret = os.getenv("LINE_CHANNEL_SECRET")
-if not channel_access_token or not channel_secret:
-    raise ValueError("LINEの認証情報が環境変数にありません")
 
-line_bot_api = LineBotApi(channel_access_token)
-handler = WebhookHandler(channel_secret)
+# LINEのクライアントは最初に使うときに作る
+_line_clients = {}
+_line_clients_lock = threading.Lock()
+
+def _line_client(name, factory):
+    client = _line_clients.get(name)
+    if client is None:
+        with _line_clients_lock:
+            client = _line_clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                client = _line_clients[name] = factory()
+                metrics.STARTUP_SECONDS.set(time.perf_counter() - started, phase=f"line_{name}")
+    return client
+
+def get_line_bot_api():
+    return _line_client("api", lambda: LineBotApi(channel_access_token))
+
+def get_webhook_parser():
+    return _line_client("parser", lambda: WebhookParser(channel_secret))
+
+# webhookイベントのハンドラ登録　(イベント型, メッセージ型, 関数)
+_event_handlers = []
+
+def on_event(event_type, message=None):
+    def decorator(func):
+        _event_handlers.append((event_type, message, func))
+        return func
+    return decorator
+
+# LINEの再送を見分けるための設定
+# メモリの集合はワーカーごとなので、複数ワーカーで動かすときは WEBHOOK_DEDUP_DB=1 でDBにも記録する
+webhook_dedup_ttl = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400"))  # 秒
+webhook_dedup_in_db = os.getenv("WEBHOOK_DEDUP_DB", "0") == "1"
+recent_event_ids = RecentEventIds(webhook_dedup_ttl, int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000")))
+_webhook_events_purged_at = 0.0  # time.monotonic()
+
+# 他のワーカーがすでに処理したイベントならFalse　DBに記録する設定のときだけ確認する
+def claim_event(event):
+    global _webhook_events_purged_at
+    event_id = getattr(event, "webhook_event_id", None)
+    if not webhook_dedup_in_db or not event_id:
+        return True
+
+    # 古い記録はときどきまとめて消す
+    if time.monotonic() - _webhook_events_purged_at > 600:
+        _webhook_events_purged_at = time.monotonic()
+        purge_webhook_events(webhook_dedup_ttl)
+
+    if claim_webhook_event(event_id):
+        return True
+    logger.info(f"[Webhook] 他のワーカーで処理済みのイベントを無視します: {event_id}")
+    metrics.WEBHOOK_DUPLICATES.inc(layer="db")
+    return False
+
+# イベントを型に合うハンドラに振り分ける（ワーカースレッドで実行される）
+def dispatch_event(event):
+    ensure_schema()  # 初回だけテーブルを確認する　webhookの応答は待たせない
+    if not claim_event(event):
+        return
+    for event_type, message_type, func in _event_handlers:
+        if not isinstance(event, event_type):
+            continue
+        if message_type is not None and not isinstance(getattr(event, "message", None), message_type):
+            continue
+        with metrics.WEBHOOK_EVENT_SECONDS.time(handler=func.__name__):
+            func(event)
+        return
+    logger.info(f"[Webhook] 未対応のイベント: {type(event).__name__}")
 
-# main.py定期実行用関数
-def periodic_check():
-    """0:05と12:05に実行する関数"""
-    while True:
-        now = datetime.now()
-        
-        # ===（本番用）===
-        if now.hour < 12 and (now.hour > 0 or now.minute >= 5):
-            # 12:05まで待つ
-           next_run = now.replace(hour=12, minute=5, second=0, microsecond=0)
-
-        elif now.hour >= 12 and (now.hour > 12 or now.minute >= 5):
-            # 明日の0:05まで待つ
-            tomorrow = now + timedelta(days=1)
-            next_run = tomorrow.replace(hour=0, minute=5, second=0, microsecond=0)
-        else:
-            # 今日の0:05まで待つ
-            next_run = now.replace(hour=0, minute=5, second=0, microsecond=0)
-        
-        
-        # === テスト用（現在時刻の1分後）===
-        #next_run = now + timedelta(minutes=1)
-        
-        # 待機時間を計算
-        wait_seconds = (next_run - now).total_seconds()
-        
-        # logger.info(f"次回実行: {next_run.strftime('%H:%M')} (約{wait_seconds/60:.0f}分後)")
-        
-        # 待機
-        time.sleep(wait_seconds)
-        
-        # 実行
-        try:
-            main()  # main関数を呼び出し
-            logger.info("定期実行完了")
-        except Exception as e:
-            logger.error(f"実行エラー: {e}")
+# 署名検証後のイベントを処理するワーカー　webhookはキューに積んだらすぐ200を返す
+event_pool = EventWorkerPool(
+    dispatch_event,
+    workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+    max_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+)
 
-# 定期実行スレッドの起動
-threading.Thread(target=periodic_check, daemon=True).start()
+# ワーカースレッドはリクエストを受けたプロセスで起動する（before_request）
+# gunicorn --preload では読み込んだ親プロセスではなく、forkした各ワーカーで起動させるため
+def start_event_pool():
+    if event_pool.start():
+        # 停止時は受付をやめ、溜まっているイベントを処理してから終了する
+        atexit.register(event_pool.shutdown, float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10")))
+
+@metrics.register_collector
+def collect_event_pool_stats():
+    for field, value in event_pool.stats().items():
+        metrics.WEBHOOK_QUEUE.set(value, field=field)
+
+# 定期実行スレッド　施設ごとに間隔を変えてスキャンする（scheduler.py）
+# 最初のリクエストを受けたときに1回だけ起動する　scheduler以下（main, scraper）の読み込みもそのスレッドで行う
+# forkした子プロセスでは親のスレッドは動いていないので、プロセスごとに起動する
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def start_scheduler():
+    global _scheduler_pid
+    if _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid():
+            return
+        _scheduler_pid = os.getpid()
+
+    def run():
+        started = time.perf_counter()
+        from scheduler import scheduler_loop
+        metrics.STARTUP_SECONDS.set(time.perf_counter() - started, phase="scraper_stack")
+        logger.info(f"[遅延初期化] スケジューラ・スクレイパー読み込み {(time.perf_counter() - started) * 1000:.0f} ms")
+        scheduler_loop()
+
+    threading.Thread(target=run, name="scheduler", daemon=True).start()
+
+# アプリケーションを作る　gunicornからは下の app を使う
+# スレッド（イベント処理のワーカー、定期実行）はここでは起動せず、最初のリクエストを受けたときに起動する
+# start_background=False なら定期実行を起動しない（スキャンをscan_worker.pyに任せるプロセスなど）
+def create_app(start_background=None):
+    setup_logging()
+    started = time.perf_counter()
+    if not channel_access_token or not channel_secret:
+        raise ValueError("LINEの認証情報が環境変数にありません")
+    if start_background is None:
+        start_background = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bot)
+
+    flask_app.before_request(start_event_pool)
+    if start_background:
+        flask_app.before_request(start_scheduler)
+
+    import_seconds = started - _process_started
+    create_seconds = time.perf_counter() - started
+    metrics.STARTUP_SECONDS.set(import_seconds, phase="import")
+    metrics.STARTUP_SECONDS.set(create_seconds, phase="create_app")
+    logger.info(
+        f"[起動] import {import_seconds * 1000:.0f} ms, create_app {create_seconds * 1000:.0f} ms "
+        f"(DB・LINE・スクレイパーは初回利用時に初期化, イベント処理=初回リクエスト時に起動, "
+        f"定期実行={'初回リクエスト時に起動' if start_background else 'なし'})"
+    )
+    return flask_app
 
 # gitActionsからCURLを受けて定期実行を行うエンドポイント
-@app.route('/trigger_scrape', methods=['GET'])
+@bot.route('/trigger_scrape', methods=['GET'])
 def trigger_scrape():
+    from scheduler import run_adaptive_tick
     try:
-        main()  # 空き確認関数など
+        status = run_adaptive_tick("trigger")  # スキャン間隔を過ぎた施設だけ　実行中・実行直後なら合流またはスキップ
+        if status == "skipped":
+            return "Skipped: scan already running or recently finished", 200
+        if status in ("idle", "throttled"):
+            return f"Skipped: {status}", 200
         return "Triggered successfully", 200
     except Exception as e:
         logger.error(f"Manual trigger error: {e}")
         return "Trigger failed", 500
 
 # 共通エンドポイント：ヘルスチェック
-@app.route("/", methods=["GET"])
+@bot.route("/", methods=["GET"])
 def index():
     return jsonify({"message": "LINE Bot & DB API が稼働中です！"})
 
+# Prometheus形式のメトリクス
+@bot.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # LINE Webhook 受信
-@app.route("/webhook", methods=["POST"])
+@bot.route("/webhook", methods=["POST"])
+@metrics.WEBHOOK_SECONDS.timed(label="route")
 def webhook():
     signature = request.headers.get("X-Line-Signature")
     body = request.get_data(as_text=True)
-    logger.info(f"[Webhook] 受信Body:\n{body}")
+    logger.debug("[Webhook] 受信Body:\n%s", body)
     try:
-        handler.handle(body, signature)
-        return "OK"
+        # 署名検証だけはここで行い、イベントの処理はワーカーに任せる
+        events = get_webhook_parser().parse(body, signature)
     except InvalidSignatureError:
         logger.error("[Webhook] 署名検証失敗")
         return "Invalid signature", 400
     except Exception as e:
-        logger.error(f"[Webhook] ハンドラーエラー: {e}")
+        logger.error(f"[Webhook] 解析エラー: {e}")
         return "Error", 500
 
+    for event in events:
+        # 再送されたイベントは処理せず200だけ返す（DB更新・スクレイピング・返信をやり直さない）
+        event_id = getattr(event, "webhook_event_id", None)
+        if event_id and not recent_event_ids.add(event_id):
+            logger.info(f"[Webhook] 処理済みのイベントの再送を無視します: {event_id}")
+            metrics.WEBHOOK_DUPLICATES.inc(layer="memory")
+            continue
+        event_pool.submit(event)
+    return "OK"
+
 # LINE Botイベントハンドラ
-@handler.add(FollowEvent)
+@on_event(FollowEvent)
 def handle_follow(event):
     try:
         user_id = event.source.user_id
@@ -128,7 +252,7 @@ def handle_follow(event):
             "このボットの説明やコマンド確認したいときは「ヘルプ」と送ってください😊"   
         )
         
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage(text=welcome_message)
         )
@@ -136,60 +260,58 @@ def handle_follow(event):
     except Exception as e:
         logger.error(f"フォローイベント処理エラー: {e}")
         # エラー時の応答
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage(text="申し訳ございません。エラーが発生しました。")
         )
 
-@handler.add(MessageEvent, message=TextMessage)
+@on_event(MessageEvent, message=TextMessage)
 def handle_text(event):
     user_id = event.source.user_id
     text = event.message.text.strip()
 
     if text == "登録":
-        flex = show_selection_flex()
-        line_bot_api.reply_message(event.reply_token, flex)
+        # 登録済みの施設には印をつける
+        registered_ids = [item["facility_id"] for item in fetch_user_wished_facilities(user_id)]
+        flex = show_selection_flex(registered_ids)
+        get_line_bot_api().reply_message(event.reply_token, flex)
         return
     
     if text == "解除":
     
         wished_facilities = wished_facilities = fetch_user_wished_facilities_for_cancel(user_id)
         if not wished_facilities:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="解除できる施設がありません。「登録」と入力して登録をおこなってください"))
+            get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text="解除できる施設がありません。「登録」と入力して登録をおこなってください"))
             return
 
         flex = show_cancell_flex(wished_facilities)
-        line_bot_api.reply_message(event.reply_token, flex)
+        get_line_bot_api().reply_message(event.reply_token, flex)
         return
 
     if text == "空き確認":
         try:
-            wished_facilities = fetch_wished_facilities()
+            wished_facilities = fetch_user_wished_facilities(user_id)
             if not wished_facilities:
                 reply = "希望施設が登録されていません。先に「登録」と入力して登録をしてください。"
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+                get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text=reply))
                 return
 
-            notifications = []
-            for wished_facility in wished_facilities:
-                notification = scrape_avl_from_calender(
-                    facility_id=wished_facility["facility_id"],
-                    facility_name=wished_facility["facility_name"],
-                    user_id=wished_facility["user_id"],
-                    is_manual=True
-                )
-                if notification:
-                    notifications.append(notification)
-            if notifications:
-                combined = "\n\n".join(notifications)
-            else:
-                combined = "希望施設に空きはありませんでした。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=combined))
-            logger.info("手動スクレイピングが実行されました")
+            # スクレイピングはせず、直近のスキャン結果から即答する
+            combined, stale_facilities = build_cached_availability_reply(wished_facilities)
+            if stale_facilities and start_manual_refresh(user_id, stale_facilities):
+                combined += "\n\n最新の空き状況を確認しています。結果は後ほどお知らせします。"
+            get_line_bot_api().reply_message(event.reply_token, to_text_messages([combined]))
+            logger.info(f"[手動確認] user_id={user_id} にキャッシュから応答 (再取得 {len(stale_facilities)} 件)")
         except Exception as e:
             logger.error(f"手動処理エラー: {e}")
         return
     
+    tokens = text.split()  # 全角スペース区切りも受け付ける
+    if tokens and tokens[0] == "条件":
+        reply = handle_conditions_command(user_id, tokens[1:])
+        get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text=reply))
+        return
+
     if text == "ヘルプ":
         logger.info(f"[ヘルプ表示開始] user_id={user_id} がヘルプの要求を受信")
 
@@ -198,13 +320,18 @@ def handle_text(event):
             "・登録：空き確認をしたい施設を登録します\n"
             "・解除：登録済み施設を解除します\n"
             "・空き確認：現在の空き状況をすぐに確認します\n"
+            "・条件：登録施設ごとに、通知する日付・曜日・泊数を指定します\n"
             "・ヘルプ：このボットの使い方を表示します\n\n"
+            "■条件の指定\n"
+            "「条件」で登録施設の番号と今の条件を表示します\n"
+            "例：条件 1 12/1〜12/31 金土 2泊\n"
+            "（条件 1 なし で条件を外します）\n\n"
             "■定期空き確認\n"
-            "毎日 0:05、12:05 に自動チェックします\n\n"
+            "登録の多い施設や空きがよく動く施設ほど、こまめに自動チェックします（15分〜12時間ごと）\n\n"
             "■注意\n"
             "このアカウントをブロックすると施設の登録がすべて解除されます"
         )
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=help_text))
+        get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text=help_text))
         logger.info(f"[ヘルプ送信完了] user_id={user_id} にヘルプ内容を送信しました")
         return
 
@@ -213,82 +340,167 @@ def handle_text(event):
 
     # いずれにも当てはまらない場合
     reply = "施設を選ぶには「希望」、予約状況を確認するには「空き確認」と入力してください。"
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
+    get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text=reply))
 
-@handler.add(PostbackEvent)
+@on_event(PostbackEvent)
 def handle_postback(event):
     user_id = event.source.user_id
     data = event.postback.data
 
+    # メニューの「次のページ」
+    page = parse_page(data, SELECT_PAGE_PREFIX)
+    if page is not None:
+        registered_ids = [item["facility_id"] for item in fetch_user_wished_facilities(user_id)]
+        get_line_bot_api().reply_message(event.reply_token, show_selection_flex(registered_ids, page))
+        return
+
+    page = parse_page(data, CANCEL_PAGE_PREFIX)
+    if page is not None:
+        get_line_bot_api().reply_message(
+            event.reply_token, show_cancell_flex(fetch_user_wished_facilities_for_cancel(user_id), page)
+        )
+        return
+
     if data.startswith("select_item_"):
         facility_id = data.replace("select_item_", "")
-        facility_name = next((item["name"] for item in get_items_from_db() if item["id"] == facility_id), None)
+        facility_name = get_facility_name(facility_id)
         register_user_selection(user_id, facility_id)
         logger.info(f"[希望登録完了] user={user_id}, facility={facility_id}")
-        line_bot_api.reply_message(event.reply_token,
+        get_line_bot_api().reply_message(event.reply_token,
             TextSendMessage(text=f"{facility_name} を予約希望施設として登録しました！\n続けて確認したいときは「確認」と入力してください"))
         
     if data.startswith("cancel_item_"):
         facility_id = data.replace("cancel_item_", "")
-        facility_name = next((item["name"] for item in get_items_from_db() if item["id"] == facility_id), None)
+        facility_name = get_facility_name(facility_id)
         cancell_user_selection(user_id, facility_id)
         logger.info(f"[希望解除完了] user={user_id}, facility={facility_id}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"{facility_name} を希望リストから解除しました\n通知は届かなくなるのでご注意ください"))
+        get_line_bot_api().reply_message(event.reply_token, TextSendMessage(text=f"{facility_name} を希望リストから解除しました\n通知は届かなくなるのでご注意ください"))
             
 
-# Flex Message生成
-def show_selection_flex():
-    items = get_items_from_db()
-    contents = [{
-        "type": "button",
-        "action": {
-            "type": "postback",
-            "label": item["name"],
-            "data": f"select_item_{item['id']}"
-        },
-        "style": "secondary"
-    } for item in items]
-
-    return FlexSendMessage(
-        alt_text="希望の施設を選択してください",
-        contents={
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": "希望の施設を選択してください", "weight": "bold", "size": "lg"}
-                ] + contents
-            }
-        }
-    )
+CONDITIONS_USAGE = (
+    "条件は「条件 番号 指定」の形で送ってください\n"
+    "・日付の範囲：12/1〜12/31（12/1〜 や 〜12/31 も可）\n"
+    "・曜日：金土、平日、週末\n"
+    "・泊数：2泊（連続して空いている日だけ通知）\n"
+    "例：条件 1 12/1〜12/31 金土 2泊\n"
+    "条件を外すとき：条件 1 なし"
+)
 
-def show_cancell_flex(wished_facilities):
-    contents = [{
-        "type": "button",
-        "action": {
-            "type": "postback",
-            "label": item["facility_name"],
-            "data": f"cancel_item_{item['facility_id']}"
-        },
-        "style": "primary",
-        "color": "#FF6666"
-    } for item in wished_facilities]
-
-    return FlexSendMessage(
-        alt_text="登録解除する施設を選択してください",
-        contents={
-            "type": "bubble",
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": "登録解除する施設を選んでください", "weight": "bold", "size": "lg"}
-                ] + contents
-            }
-        }
-    )
+# 「条件」コマンド　引数なしなら登録施設の番号と今の条件を、「番号 指定...」なら条件を保存して返信文を返す
+def handle_conditions_command(user_id, args):
+    wished_facilities = fetch_user_wished_facilities(user_id)
+    if not wished_facilities:
+        return "希望施設が登録されていません。先に「登録」と入力して登録をしてください。"
+
+    if not args:
+        lines = [
+            f"{number}. {item['facility_name']}：{format_conditions(item.get('conditions') or NO_CONDITIONS)}"
+            for number, item in enumerate(wished_facilities, 1)
+        ]
+        return "■登録施設の条件\n" + "\n".join(lines) + "\n\n" + CONDITIONS_USAGE
+
+    if not args[0].isdigit() or not 1 <= int(args[0]) <= len(wished_facilities):
+        return f"施設の番号は1〜{len(wished_facilities)}で指定してください。「条件」で番号を確認できます。"
+    if len(args) == 1:
+        return CONDITIONS_USAGE
+
+    item = wished_facilities[int(args[0]) - 1]
+    try:
+        conditions = parse_conditions(args[1:])
+    except ValueError as e:
+        return f"{e}\n\n{CONDITIONS_USAGE}"
+
+    if not update_wish_conditions(user_id, item["facility_id"], conditions):
+        return "条件を保存できませんでした。時間をおいてもう一度お試しください。"
+    logger.info(f"[条件登録完了] user={user_id}, facility={item['facility_id']}, 条件={conditions}")
+    return f"{item['facility_name']} の通知条件を「{format_conditions(conditions)}」にしました"
+
+# Flex Message生成　施設一覧の版ごとに組み立て済みのカルーセルを使う（flex_menus.py）
+def show_selection_flex(registered_ids=(), page=0):
+    version, items = get_facility_catalog()
+    return selection_message(version, items, registered_ids, page)
+
+def show_cancell_flex(wished_facilities, page=0):
+    version, items = get_facility_catalog()
+    return cancel_message(version, items, wished_facilities, page)
+
+
+# 「空き確認」でキャッシュを新しいとみなす秒数　これより古い施設はバックグラウンドで取り直す
+manual_check_max_age = int(os.getenv("MANUAL_CHECK_MAX_AGE", "600"))
+
+_manual_refresh_users = set()  # バックグラウンド再取得中のuser_id　連打で多重に走らないようにする
+_manual_refresh_lock = threading.Lock()
+
+# 直近のスナップショットから「空き確認」の返信文を作る
+# 戻り値: (返信文, スナップショットがない/古い施設のリスト)
+def build_cached_availability_reply(wished_facilities):
+    from scraper import format_availability_message
+    snapshots = fetch_availability_snapshots([item["facility_id"] for item in wished_facilities])
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    notifications = []
+    stale_facilities = []
+    for item in wished_facilities:
+        snapshot = snapshots.get(item["facility_id"])
+        if snapshot is None:
+            notifications.append(f"{item['facility_name']}はまだ空き状況を取得していません。")
+            stale_facilities.append(item)
+            continue
+
+        if snapshot["age_seconds"] > manual_check_max_age:
+            stale_facilities.append(item)
+
+        available_dates = [d for d in snapshot["available_dates"] if d >= today]
+        available_dates = list(filter_dates(available_dates, item.get("conditions") or NO_CONDITIONS))
+        notification = format_availability_message(
+            item["facility_id"], item["facility_name"], available_dates, is_manual=True
+        )
+        notifications.append(f"{notification}\n（約{int(snapshot['age_seconds'] // 60)}分前の情報）")
+
+    return "\n\n".join(notifications), stale_facilities
+
+# 本文を5000文字以内のテキストメッセージに分ける　1回の返信・プッシュで送れるのは5件まで
+def to_text_messages(texts):
+    messages = pack_texts(texts)
+    if len(messages) > 5:
+        logger.warning(f"[メッセージ分割] {len(messages)} 件のうち先頭5件のみ送信します")
+    return [TextSendMessage(text=text) for text in messages[:5]]
+
+# 古い施設を別スレッドで取り直し、結果をプッシュで届ける
+# ここではスナップショットを更新しない（定期実行の差分通知が他の希望者に届かなくなるため）
+def start_manual_refresh(user_id, wished_facilities):
+    with _manual_refresh_lock:
+        if user_id in _manual_refresh_users:
+            return False
+        _manual_refresh_users.add(user_id)
+
+    def refresh():
+        from scraper import scan_facilities, format_availability_message, bookable_months
+        try:
+            # 条件の期間にかかる月だけを取りに行く
+            months = bookable_months()
+            scan_results = scan_facilities([
+                dict(item, months=needed_months(item.get("conditions") or NO_CONDITIONS, months))
+                for item in wished_facilities
+            ])
+            notifications = [
+                format_availability_message(
+                    item["facility_id"], item["facility_name"],
+                    list(filter_dates(scan_results[item["facility_id"]]["available_dates"], item.get("conditions") or NO_CONDITIONS)),
+                    is_manual=True
+                )
+                for item in wished_facilities
+            ]
+            get_line_bot_api().push_message(user_id, to_text_messages(notifications))
+            logger.info(f"[手動確認] user_id={user_id} に最新の空き状況を送信しました")
+        except Exception as e:
+            logger.error(f"[手動確認] 再取得エラー user_id={user_id}: {e}")
+        finally:
+            with _manual_refresh_lock:
+                _manual_refresh_users.discard(user_id)
 
+    threading.Thread(target=refresh, daemon=True).start()
+    return True
 
 # 通知希望者に通知を送る
 def notify_user(user_id: str, message: str):
@@ -308,7 +520,7 @@ def notify_user(user_id: str, message: str):
         logger.error(f"LINE通知送信エラー: {e}")
 
 # フォローを外した（ブロック）ユーザのデータを消す
-@handler.add(UnfollowEvent)
+@on_event(UnfollowEvent)
 def handle_unfollow(event):
     user_id = event.source.user_id
     logger.info(f"UnfollowEvent 受信: user_id={user_id}")
@@ -317,6 +529,8 @@ def handle_unfollow(event):
     remove_user_from_db(user_id)
 
 
+app = create_app()
+
 # Flask起動
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,168 @@
+# logging_setup.py
+
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import metrics
+
+# ログの出力設定をまとめて行う　各モジュールは logging.getLogger(__name__) を使うだけにして、
+# 起動するところ（main.py / line_bot_server.create_app / scan_worker.py / subscription_io.py）で setup_logging() を呼ぶ
+#
+# ログは呼び出したスレッドではキューに積むだけにして、書き出しは専用のスレッド（QueueListener）で行う
+# スキャンやwebhookの処理がログの書き出しを待たないようにするため
+# 書き出し用のスレッドは最初にログを積んだプロセスで起動し、forkした子プロセス（gunicorn --preload）では起動し直す
+#
+#   LOG_LEVEL=INFO                         # 全体のレベル
+#   LOG_LEVELS=scraper=DEBUG,db_utils=WARNING  # モジュールごとのレベル
+#   LOG_DEBUG_SAMPLE_EVERY=10              # DEBUGは書いた場所ごとに最初の1件と、以降N件に1件だけ出す（1で全件）
+#   LOG_FORMAT=json                        # 1行1JSONで出す（集計ログの項目も列として出る）
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+module_levels = os.getenv("LOG_LEVELS", "")
+debug_sample_every = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", "10"))
+log_format = os.getenv("LOG_FORMAT", "text")
+log_async = os.getenv("LOG_ASYNC", "1") == "1"  # 0にするとその場で書き出す（デバッグ用）
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 書き出しが追いつかずこれを超えたら捨てる
+
+LOG_RECORDS_DROPPED = metrics.counter("log_records_dropped_total", "キューがいっぱいで捨てたログの件数")
+
+_setup_lock = threading.Lock()
+_queue_handler = None
+_configured = False
+
+# DEBUG以下のログを書いた場所（ロガー名と行番号）ごとに間引くフィルター
+# INFO以上はそのまま通す
+class DebugSampler(logging.Filter):
+
+    def __init__(self, every):
+        super().__init__()
+        self._every = max(every, 1)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self._every == 1:
+            return True
+        key = (record.name, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self._every == 0
+
+# キューに積み、別スレッドで target に書き出すハンドラ　キューがいっぱいのときは待たずに捨てる
+class NonBlockingQueueHandler(QueueHandler):
+
+    def __init__(self, target, max_size):
+        self._target = target
+        self._max_size = max_size
+        super().__init__(None)
+        self._reset()
+        # 子プロセスには親の書き出し用スレッドがないので、親のキューを捨てて未起動の状態に戻す
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.queue = queue.Queue(maxsize=self._max_size)
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self._listener is None:
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self._listener is None:
+                listener = QueueListener(self.queue, self._target, respect_handler_level=True)
+                listener.start()
+                self._listener = listener
+
+    # キューに残っているログを書き出して、書き出し用のスレッドを止める
+    def stop(self):
+        with self._start_lock:
+            listener, self._listener = self._listener, None
+        if listener:
+            listener.stop()
+
+# 1行1JSONの形式　log_summary() で渡した項目はそのまま列にする
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        summary = getattr(record, "summary", None)
+        if summary:
+            entry.update(summary)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# "scraper=DEBUG,db_utils=WARNING" → {"scraper": "DEBUG", "db_utils": "WARNING"}
+def parse_module_levels(text):
+    levels = {}
+    for item in text.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+# ログの出力先を設定する　何回呼んでも最初の1回だけ設定する
+def setup_logging():
+    global _queue_handler, _configured
+    with _setup_lock:
+        if _configured:
+            return
+        _configured = True
+
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(LOG_FORMAT))
+
+        if log_async:
+            handler = _queue_handler = NonBlockingQueueHandler(stream_handler, log_queue_size)
+            atexit.register(stop_logging)
+        else:
+            handler = stream_handler
+        handler.addFilter(DebugSampler(debug_sample_every))
+
+        root = logging.getLogger()
+        for old_handler in list(root.handlers):
+            root.removeHandler(old_handler)
+        root.addHandler(handler)
+        root.setLevel(log_level)
+
+        for name, level in parse_module_levels(module_levels).items():
+            logging.getLogger(name).setLevel(level)
+
+# キューに残っているログを書き出して、書き出し用のスレッドを止める
+def stop_logging():
+    if _queue_handler:
+        _queue_handler.stop()
+
+# 1回の処理のまとめを1行で出す　LOG_FORMAT=json のときは fields の各項目が列になる
+# 書き出しは別スレッドで行うので、呼び出し元が後から fields を変えても影響しないよう複製して渡す
+#   log_summary(logger, "スキャン集計", {"facilities": 10, "notices": 3})
+#   → [スキャン集計] facilities=10 notices=3
+def log_summary(logger, tag, fields, level=logging.INFO):
+    if not logger.isEnabledFor(level):
+        return
+    text = " ".join(f"{key}={_format_value(value)}" for key, value in fields.items())
+    logger.log(level, f"[{tag}] {text}", extra={"summary": dict(fields)})
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return value
@@ -1,68 +1,287 @@
 # main.py
 
-from db_utils import create_tables
+from db_utils import ensure_schema
 from db_utils import save_facilities
 from db_utils import fetch_wished_facilities
-from scraper import scrape_facility_names_ids
-from scraper import scrape_avl_from_calender
-from db_utils import fetch_wished_facilities
-from linebot.models import TextSendMessage
+from db_utils import fetch_wished_facilities_by_facility
+from db_utils import fetch_availability_snapshots
+from db_utils import save_availability_snapshots
+from db_utils import fetch_calendar_fingerprints
+from db_utils import save_calendar_fingerprints
+from db_utils import acquire_scan_lease
+from db_utils import renew_scan_lease
+from db_utils import release_scan_lease
+from scraper import KENPO_BASE_URL
+from scraper import refresh_facility_catalog
+from scraper import invalidate_facility_catalog
+from scraper import scan_facilities
+from scraper import bookable_months
+from scraper import format_availability_message
+from notifier import NotificationDispatcher
+from logging_setup import setup_logging
+from logging_setup import log_summary
+from wish_conditions import NO_CONDITIONS
+from wish_conditions import conditions_key
+from wish_conditions import filter_dates
+from wish_conditions import union_months
 from linebot import LineBotApi
 import logging
 from dotenv import load_dotenv
 import os
+import time
+from datetime import datetime
+import uuid
+import metrics
+import socket
+import threading
 
 # ロガー設定
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
 # LINE Bot 認証情報
 load_dotenv()
 channel_access_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 channel_secret = os.getenv("LINE_CHANNEL_SECRET")
-if not channel_access_token or not channel_secret:
-    raise ValueError("LINEの認証情報が環境変数にありません")
 
-line_bot_api = LineBotApi(channel_access_token)
+# 通知の送信に使うクライアント　importを軽くするため最初のスキャンで作る（ベンチマークなどでは差し替える）
+line_bot_api = None
+_line_bot_api_lock = threading.Lock()
+
+def get_line_bot_api():
+    global line_bot_api
+    if line_bot_api is None:
+        with _line_bot_api_lock:
+            if line_bot_api is None:
+                if not channel_access_token or not channel_secret:
+                    raise ValueError("LINEの認証情報が環境変数にありません")
+                line_bot_api = LineBotApi(channel_access_token)
+    return line_bot_api
+
+# スキャンの排他設定　gunicornの複数ワーカーとGitHub Actionsからのトリガーで同じスキャンが重複しないようにする
+SCAN_LEASE_NAME = "scheduled_scan"
+scan_lease_ttl = int(os.getenv("SCAN_LEASE_TTL", "1800"))  # リースの有効秒数　これを過ぎたら落ちたとみなす
+scan_min_interval = int(os.getenv("SCAN_MIN_INTERVAL", "600"))  # 前回の終了からこの秒数以内なら実行しない
+
+_local_scan_lock = threading.Lock()
+
+# スキャンを全プロセスで1つだけ実行する
+# facility_ids を渡すとその施設だけをスキャンする（Noneなら希望のある全施設）
+# min_interval を渡すと前回の終了からの待ち時間を上書きする（スケジューラの短い間隔の実行用）
+# 戻り値: "completed"（実行した） / "joined"（同じプロセスの実行中スキャンの完了を待った） / "skipped"（他で実行中・実行直後）
+def run_scan_once(trigger, facility_ids=None, min_interval=None):
+    # 同じプロセス内ですでに走っていれば、新しく始めずその完了を待つ
+    if not _local_scan_lock.acquire(blocking=False):
+        logger.info(f"[スキャン合流] trigger={trigger} 実行中のスキャンの完了を待ちます")
+        with _local_scan_lock:
+            metrics.SCAN_RUNS.inc(trigger=trigger, status="joined")
+            return "joined"
+
+    try:
+        holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        if min_interval is None:
+            min_interval = scan_min_interval
+        if not acquire_scan_lease(SCAN_LEASE_NAME, holder, scan_lease_ttl, min_interval):
+            logger.info(f"[スキャンスキップ] trigger={trigger} 他のプロセスが実行中か、実行した直後です")
+            metrics.SCAN_RUNS.inc(trigger=trigger, status="skipped")
+            return "skipped"
+
+        # 実行中はリースの期限を延ばし続ける
+        stop_renewal = threading.Event()
+
+        def renew():
+            while not stop_renewal.wait(scan_lease_ttl / 3):
+                if not renew_scan_lease(SCAN_LEASE_NAME, holder, scan_lease_ttl):
+                    logger.warning(f"[リース更新失敗] holder={holder}")
 
-# サービス起動時に1回だけ実行　各テーブルを作成
-create_tables()
+        threading.Thread(target=renew, daemon=True).start()
+        try:
+            logger.info(f"[スキャン開始] trigger={trigger}, holder={holder}")
+            main(facility_ids)
+            metrics.SCAN_RUNS.inc(trigger=trigger, status="completed")
+            return "completed"
+        except Exception:
+            metrics.SCAN_RUNS.inc(trigger=trigger, status="failed")
+            raise
+        finally:
+            stop_renewal.set()
+            release_scan_lease(SCAN_LEASE_NAME, holder)
+    finally:
+        _local_scan_lock.release()
 
-def main():
+def main(facility_ids=None):
+    started = time.monotonic()
+    ensure_schema()  # 初回だけ各テーブルを作成する
     
     # 施設の名前とURL一覧を取得
-    facility_url = "https://as.its-kenpo.or.jp/apply/empty_calendar?s=PT13TjJjVFBrbG1KbFZuYzAxVFp5Vkhkd0YyWWZWR2JuOTJiblpTWjFKSGQ5a0hkdzFXWg%3D%3D&join_date=&night_count=1"
+    facility_url = f"{KENPO_BASE_URL}/apply/empty_calendar?s=PT13TjJjVFBrbG1KbFZuYzAxVFp5Vkhkd0YyWWZWR2JuOTJiblpTWjFKSGQ5a0hkdzFXWg%3D%3D&join_date=&night_count=1"
     # "https://linebottester.github.io/kenpo_test_site/test_calendar.html" # テスト用
 
-    # 施設名と施設IDを取得する　毎回見に行くのはナンセンスな気がする　月初めのみに限定すべきか
-    #　if isfirst == 1 or datetime.today().day == 1:　#　例えばこんな感じとか
-    # isfirst = 0 # 実行後0にする
-
-    facilities = scrape_facility_names_ids(facility_url)
-    save_facilities(facilities) #取得してきた施設と施設IDをDBへ保存
+    # 施設名と施設IDを取得する　施設の増減はまれなので、キャッシュの有効期間内は見に行かず
+    # 期限切れでも内容が変わっていなければDBへの保存を省略する
+    facilities, catalog_changed = refresh_facility_catalog(facility_url)
+    if catalog_changed and not save_facilities(facilities): #取得してきた施設と施設IDをDBへ保存
+        invalidate_facility_catalog()
 
     # 希望されている施設IDと名前をDBから取得してきて
-    wished_facilities = fetch_wished_facilities()
+    if facility_ids is None:
+        wished_facilities = fetch_wished_facilities()
+    else:
+        wished_facilities = fetch_wished_facilities_by_facility(facility_ids)
 
-    # 希望のある施設のみをスクレイピングする
-    for wished_facility in wished_facilities:
-        result = scrape_avl_from_calender(
-            facility_id=wished_facility["facility_id"],
-            facility_name=wished_facility["facility_name"],
-            user_id=wished_facility["user_id"],
-            is_manual=False
+    # 希望のある施設のみを、施設ごとに1回だけ（並列で）スクレイピングする
+    # 取りに行くのは希望者の条件（日付の範囲）にかかる月だけで、前回と同じ内容の月は条件付きリクエストと指紋の比較だけで済ませる
+    plans = plan_facility_scans(wished_facilities)
+    planned_ids = [plan["facility_id"] for plan in plans]
+    scan_results = scan_facilities(plans, fetch_calendar_fingerprints(planned_ids))
+
+    # 前回スキャン時の空き日と比べて、新しく空いた日だけを通知する
+    snapshots = fetch_availability_snapshots(planned_ids)
+    new_snapshots = {}
+    dispatcher = NotificationDispatcher(get_line_bot_api())
+    notice_count = 0
+
+    for plan in plans:
+        scan_result = scan_results[plan["facility_id"]]
+        snapshot = snapshots.get(plan["facility_id"])
+
+        # どの月も前回と変わらず、前回のスキャン後に登録した人もいなければ比較は要らない
+        if scan_result["unchanged"] and snapshot is not None and not has_new_subscribers(plan, snapshot):
+            new_snapshots[plan["facility_id"]] = merge_snapshot(scan_result, set(snapshot["available_dates"]))
+            continue
+
+        notifications, new_snapshots[plan["facility_id"]] = diff_availability(
+            plan, scan_result, snapshot
         )
-        
-        # 通知メッセージが返ってきた場合のみ送信
-        if result:
-            try:
-                line_bot_api.push_message(
-                    wished_facility["user_id"],
-                    TextSendMessage(text=result)
-                )
-                logger.info(f"[定期通知送信完了] user_id={wished_facility['user_id']} → {wished_facility['facility_name']}")
-            except Exception as e:
-                logger.error(f"[定期通知失敗] user_id={wished_facility['user_id']} → {e}")
+
+        # 新しい空きがない場合は送信しない
+        if not notifications:
+            logger.info(f" 定期実行：新しい空きなし → facility_name={plan['facility_name']}, 希望者数={len(plan['user_ids'])}")
+            continue
+
+        # 通知はユーザーごとにまとめて送るので、ここでは溜めるだけ
+        for dates, user_ids in notifications.items():
+            result = format_availability_message(
+                plan["facility_id"], plan["facility_name"], list(dates), is_manual=False
+            )
+            for user_id in user_ids:
+                dispatcher.add(user_id, result)
+                notice_count += 1
+
+    save_availability_snapshots(new_snapshots)
+    save_calendar_fingerprints(
+        {facility_id: result["fingerprints"] for facility_id, result in scan_results.items() if result["fingerprints"]},
+        datetime.now().strftime("%Y-%m")
+    )
+    dispatcher.close()
+
+    # 1回の実行のまとめ　/metrics の scan_last{field=...} に載せる
+    summary = {
+        "duration_seconds": time.monotonic() - started,
+        "wishes": len(wished_facilities),
+        "facilities": len(plans),
+        "months": sum(len(result["scanned_months"]) + len(result["failed_months"]) for result in scan_results.values()),
+        "failed_months": sum(len(result["failed_months"]) for result in scan_results.values()),
+        "unchanged_facilities": sum(1 for result in scan_results.values() if result["unchanged"]),
+        "notices": notice_count,
+        "push_requests": dispatcher.sent_requests,
+        "push_failures": dispatcher.failed_requests,
+        "finished_at": time.time()
+    }
+    for field, value in summary.items():
+        metrics.SCAN_LAST.set(value, field=field)
+    metrics.SCAN_DURATION_SECONDS.observe(summary["duration_seconds"])
+    log_summary(logger, "スキャン集計", summary)
+
+    # 取得できなかった月がある施設（ジョブのワーカーが再実行に回す）
+    summary["failed_facility_ids"] = [
+        facility_id for facility_id, result in scan_results.items() if result["failed_months"]
+    ]
+    return summary
+
+# 施設1件分のスキャン結果を前回のスナップショットと比べ、
+# 希望者ごとに通知すべき空き日（その人の条件に合う日だけ）と、次回に保存するスナップショットを返す
+# 戻り値: ({(空き日, ...): [user_id, ...]}, [保存する空き日, ...])
+def diff_availability(plan, scan_result, snapshot):
+    current_dates = scan_result["available_dates"]
+    current_set = set(current_dates)
+
+    if snapshot is None:
+        previous_dates = set()
+        scanned_at = None
+    else:
+        previous_dates = set(snapshot["available_dates"])
+        scanned_at = snapshot["scanned_at"]
+    sorted_previous = sorted(previous_dates)
+
+    # 条件ごとに (条件に合う今の空き, そのうち前回は条件に合わなかった日)　同じ条件の希望者で使いまわす
+    matches = {}
+    notifications = {}
+    for user_id in plan["user_ids"]:
+        conditions = plan["conditions"].get(user_id, NO_CONDITIONS)
+        key = conditions_key(conditions)
+        if key not in matches:
+            all_dates = filter_dates(current_dates, conditions, current_set)
+            before = set(filter_dates(sorted_previous, conditions, previous_dates))
+            matches[key] = (all_dates, tuple(d for d in all_dates if d not in before))
+        all_dates, new_dates = matches[key]
+
+        subscribed_at = plan["subscribed_at"].get(user_id)
+        # 前回のスキャン後に登録した人は、まだ何も受け取っていないので現在の空きをすべて送る
+        if scanned_at is None or subscribed_at is None or subscribed_at >= scanned_at:
+            dates = all_dates
+        else:
+            dates = new_dates
+        if dates:
+            notifications.setdefault(dates, []).append(user_id)
+
+    return notifications, merge_snapshot(scan_result, previous_dates)
+
+# 次回に保存するスナップショット　今回取得できた月は今回の空き日にし、
+# 取りに行かなかった月や取得に失敗した月は、空き日が消えたと誤判定しないよう前回分を残す（過ぎた日は除く）
+def merge_snapshot(scan_result, previous_dates):
+    scanned = set(scan_result["scanned_months"])
+    today = datetime.now().strftime("%Y-%m-%d")
+    kept = [d for d in previous_dates if d[:7] not in scanned and d >= today]
+    if not kept:
+        return list(scan_result["available_dates"])
+    return sorted(set(scan_result["available_dates"]).union(kept))
+
+# 前回のスキャンより後に登録した希望者がいるか（その人にはまだ何も送っていない）
+def has_new_subscribers(plan, snapshot):
+    return any(
+        subscribed_at is None or subscribed_at >= snapshot["scanned_at"]
+        for subscribed_at in plan["subscribed_at"].values()
+    )
+
+# user_wishesの行（ユーザー×施設）を施設IDごとにまとめる
+# スクレイピング回数を購読数ではなく施設数に比例させるため
+# 取りに行く月（months）は、希望者の条件の期間にかかる月を合わせたもの　どの月も要らない施設はスキャンしない
+def plan_facility_scans(wished_facilities, months=None):
+    months = bookable_months() if months is None else months
+    plans = {}
+    for wished_facility in wished_facilities:
+        plan = plans.setdefault(wished_facility["facility_id"], {
+            "facility_id": wished_facility["facility_id"],
+            "facility_name": wished_facility["facility_name"],
+            "user_ids": [],
+            "subscribed_at": {},
+            "conditions": {}
+        })
+        plan["user_ids"].append(wished_facility["user_id"])
+        plan["subscribed_at"][wished_facility["user_id"]] = wished_facility.get("created_at")
+        plan["conditions"][wished_facility["user_id"]] = wished_facility.get("conditions") or NO_CONDITIONS
+
+    for plan in plans.values():
+        plan["months"] = union_months(plan["conditions"].values(), months)
+    scheduled = [plan for plan in plans.values() if plan["months"]]
+
+    logger.info(
+        f"[スキャン計画] 希望 {len(wished_facilities)} 件 → 施設 {len(scheduled)} 件"
+        f"（条件の期間外で省いた施設 {len(plans) - len(scheduled)} 件） / "
+        f"ページ {sum(len(plan['months']) for plan in scheduled)} 件（最大 {len(plans) * len(months)} 件）"
+    )
+    return scheduled
     
 if __name__ == "__main__":
+    setup_logging()
     main()
@@ -0,0 +1,60 @@
+# message_renderer.py
+
+from datetime import date
+from functools import lru_cache
+
+MAX_TEXT_LENGTH = 5000  # LINEのテキストメッセージ1件の最大文字数
+WEEKDAYS = "月火水木金土日"
+DATE_SEPARATOR = "、"
+
+# "2025-07-05" → "7月5日（土）"　同じ日付は何度も出てくるので結果を覚えておく
+@lru_cache(maxsize=2048)
+def format_date_label(date_str):
+    d = date.fromisoformat(date_str)
+    return f"{d.month}月{d.day}日（{WEEKDAYS[d.weekday()]}）"
+
+# 施設1件分の通知本文を作る　空きがない場合、定期実行では空文字を返す
+# 同じ施設・同じ空き日の本文は希望者全員で共通なので、1回だけ組み立てて使いまわす
+@lru_cache(maxsize=512)
+def render_availability(facility_name, calendar_url, available_dates, is_manual):
+    if not available_dates:
+        if is_manual:
+            return f"{facility_name}には現在予約可能な日程がありません。"
+        return ""
+
+    return (
+        f"{facility_name}の次の日程に空きがあります。\n"
+        + DATE_SEPARATOR.join(format_date_label(d) for d in sorted(available_dates))
+        + f"\n\n予約ページはこちら：{calendar_url}"
+    )
+
+# 長すぎる本文を、日付の区切りや改行の位置でlimit文字以内に分ける
+def split_text(text, limit=MAX_TEXT_LENGTH):
+    chunks = []
+    while len(text) > limit:
+        cut = max(text.rfind(DATE_SEPARATOR, 0, limit), text.rfind("\n", 0, limit))
+        if cut <= 0:
+            cut = limit - 1  # 区切りがなければ上限で切る
+        chunks.append(text[:cut + 1].rstrip("\n"))
+        text = text[cut + 1:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+# 複数の本文を空行でつなぎ、1件あたりlimit文字以内のメッセージに詰める
+def pack_texts(texts, separator="\n\n", limit=MAX_TEXT_LENGTH):
+    messages = []
+    current = ""
+    for text in texts:
+        for chunk in split_text(text, limit):
+            if not current:
+                current = chunk
+            elif len(current) + len(separator) + len(chunk) <= limit:
+                current += separator + chunk
+            else:
+                messages.append(current)
+                current = chunk
+
+    if current:
+        messages.append(current)
+    return messages
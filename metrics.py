@@ -0,0 +1,168 @@
+# metrics.py
+
+from contextlib import contextmanager
+from functools import wraps
+import time
+import threading
+
+# Prometheusのテキスト形式で出力する、プロセス内の簡易メトリクス
+# （gunicornのワーカーごとに別々に集計される）
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {}  # name -> メトリクス
+_collectors = []  # 出力時に値を集める関数
+_registry_lock = threading.Lock()
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {value}"]
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    # with metrics.CALENDAR_FETCH_SECONDS.time(): ... の形で処理時間を記録する
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    # 関数の実行時間を、関数名をラベルにして記録するデコレータ
+    def timed(self, label="function"):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**{label: func.__name__}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _render_value(self, key, state):
+        lines = [
+            f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {count}"
+            for bound, count in zip(self.buckets, state["counts"])
+        ]
+        lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {state['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(key)} {state['sum']}")
+        lines.append(f"{self.name}_count{_format_labels(key)} {state['count']}")
+        return lines
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+def counter(name, help_text):
+    return _register(Counter(name, help_text))
+
+def gauge(name, help_text):
+    return _register(Gauge(name, help_text))
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, buckets))
+
+# /metrics の出力時に呼ばれ、その時点の値をGaugeに書き込む関数を登録する（キューの長さなど）
+def register_collector(func):
+    with _registry_lock:
+        _collectors.append(func)
+    return func
+
+def render():
+    for collect in list(_collectors):
+        collect()
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in sorted(metrics, key=lambda m: m.name):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- スキャン（its-kenpo） ---
+CATALOG_FETCH_SECONDS = histogram("kenpo_catalog_fetch_seconds", "施設一覧ページの取得と解析にかかった時間")
+CALENDAR_FETCH_SECONDS = histogram("kenpo_calendar_fetch_seconds", "カレンダー1か月分の取得にかかった時間")
+CALENDAR_PARSE_SECONDS = histogram("kenpo_calendar_parse_seconds", "カレンダー1か月分の解析にかかった時間", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+HTTP_REQUESTS = counter("kenpo_http_requests_total", "its-kenpoへのHTTPリクエスト数")
+HTTP_ERRORS = counter("kenpo_http_errors_total", "its-kenpoへのリクエストの失敗数（最終的な失敗）")
+HTTP_RETRIES = counter("kenpo_http_retries_total", "its-kenpoへのリクエストの再試行数")
+CACHE_HITS = counter("cache_hits_total", "キャッシュで処理できた回数")
+CACHE_MISSES = counter("cache_misses_total", "キャッシュで処理できなかった回数")
+
+# --- DB ---
+DB_QUERY_SECONDS = histogram("db_query_seconds", "db_utilsの各関数の実行時間（接続の貸出を含む）")
+
+# --- LINE ---
+LINE_PUSH_SECONDS = histogram("line_push_seconds", "LINEへのpush/multicast 1リクエストにかかった時間")
+LINE_PUSHES = counter("line_pushes_total", "LINEへのpush/multicastリクエスト数")
+LINE_PUSH_RECIPIENTS = counter("line_push_recipients_total", "LINEへの送信が成功した宛先数")
+
+# --- 1回のスキャンのまとめ ---
+SCAN_RUNS = counter("scan_runs_total", "スキャンの実行回数")
+SCAN_DURATION_SECONDS = histogram("scan_duration_seconds", "スキャン1回にかかった時間", buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+SCAN_LAST = gauge("scan_last", "直近のスキャンの集計値")
+
+# --- 起動 ---
+STARTUP_SECONDS = gauge("startup_seconds", "起動時・初回利用時の初期化にかかった時間")
+
+# --- webhook ---
+WEBHOOK_SECONDS = histogram("webhook_request_seconds", "/webhookの応答にかかった時間")
+WEBHOOK_EVENT_SECONDS = histogram("webhook_event_seconds", "webhookイベント1件の処理にかかった時間")
+WEBHOOK_QUEUE = gauge("webhook_queue", "webhookイベントキューの状態")
+WEBHOOK_DUPLICATES = counter("webhook_duplicate_events_total", "再送とみなして処理しなかったwebhookイベント数")
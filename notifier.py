@@ -0,0 +1,145 @@
+# notifier.py
+
+from concurrent.futures import ThreadPoolExecutor
+from linebot.models import TextSendMessage
+from linebot.exceptions import LineBotApiError
+from message_renderer import pack_texts
+from logging_setup import log_summary
+import os
+import copy
+import time
+import uuid
+import logging
+import threading
+import metrics
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+# LINE Messaging APIの制限（テキスト1件の文字数は message_renderer.MAX_TEXT_LENGTH）
+MAX_MESSAGES_PER_REQUEST = 5  # 1回のpush/multicastで送れるメッセージ数
+MAX_MULTICAST_RECIPIENTS = 500  # 1回のmulticastで送れる宛先数
+
+# 送信設定
+push_workers = int(os.getenv("LINE_PUSH_WORKERS", "4"))  # 送信スレッド数
+push_max_retries = int(os.getenv("LINE_PUSH_MAX_RETRIES", "5"))  # 429/5xx時の再試行回数
+push_retry_backoff = float(os.getenv("LINE_PUSH_RETRY_BACKOFF", "1.0"))  # 再試行の待ち時間の基準（秒）
+push_rate_limit = float(os.getenv("LINE_PUSH_RATE_LIMIT", "100"))  # 1秒あたりの最大リクエスト数
+
+# 施設ごとの通知文をユーザー単位でまとめ、同じ内容の宛先はmulticastで一括送信する
+# add()で通知を溜め、flush()で送信を送信スレッドに渡し、close()で送信完了を待つ（1回の実行ごとに作り直す）
+class NotificationDispatcher:
+
+    def __init__(self, line_bot_api):
+        self.line_bot_api = line_bot_api
+        self._pending = {}  # user_id -> [通知文, ...]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=push_workers)
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._local = threading.local()
+        self.sent_requests = 0
+        self.failed_requests = 0
+
+    # 1ユーザー宛の通知文を追加する
+    def add(self, user_id, text):
+        with self._lock:
+            self._pending.setdefault(user_id, []).append(text)
+
+    # 溜まった通知をユーザーごとにまとめ、送信スレッドに渡す
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        # まとめた結果が同じユーザーを1つの宛先グループにする
+        groups = {}
+        for user_id, texts in pending.items():
+            groups.setdefault(tuple(pack_texts(texts)), []).append(user_id)
+
+        # 5件を超える分は続けて送る　同じ宛先の分割は順番が入れ替わらないよう1つの送信スレッドで順に送る
+        for messages, user_ids in groups.items():
+            batches = [
+                [TextSendMessage(text=text) for text in messages[i:i + MAX_MESSAGES_PER_REQUEST]]
+                for i in range(0, len(messages), MAX_MESSAGES_PER_REQUEST)
+            ]
+            for j in range(0, len(user_ids), MAX_MULTICAST_RECIPIENTS):
+                recipients = user_ids[j:j + MAX_MULTICAST_RECIPIENTS]
+                self._executor.submit(self._send_batches, recipients, batches)
+
+        logger.info(f"[通知まとめ] ユーザー {len(pending)} 人 → 送信内容 {len(groups)} 種類")
+
+    # flushした送信がすべて終わるまで待つ
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        log_summary(logger, "通知送信完了", {"sent_requests": self.sent_requests, "failed_requests": self.failed_requests})
+
+    def _throttle(self):
+        if push_rate_limit <= 0:
+            return
+        with self._rate_lock:
+            now = time.monotonic()
+            wait_seconds = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + 1 / push_rate_limit
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    # LineBotApiはリトライキーを共有のheadersに書き込むため、送信スレッドごとに複製を使う
+    # （共有すると別の送信に他のリトライキーが付き、409で握りつぶされてしまう）
+    def _thread_api(self):
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = copy.copy(self.line_bot_api)
+            api.headers = dict(self.line_bot_api.headers)
+            self._local.api = api
+        return api
+
+    def _send_batches(self, user_ids, batches):
+        for messages in batches:
+            self._send(user_ids, messages)
+
+    def _send(self, user_ids, messages):
+        # 再試行しても二重送信にならないよう、同じリトライキーを使いまわす
+        retry_key = str(uuid.uuid4())
+        line_bot_api = self._thread_api()
+
+        for attempt in range(push_max_retries + 1):
+            self._throttle()
+            kind = "push" if len(user_ids) == 1 else "multicast"
+            try:
+                with metrics.LINE_PUSH_SECONDS.time(kind=kind):
+                    if len(user_ids) == 1:
+                        line_bot_api.push_message(user_ids[0], messages, retry_key=retry_key)
+                    else:
+                        line_bot_api.multicast(user_ids, messages, retry_key=retry_key)
+                metrics.LINE_PUSHES.inc(kind=kind, result="ok")
+                metrics.LINE_PUSH_RECIPIENTS.inc(len(user_ids))
+                self._count("sent_requests")
+                logger.debug("[定期通知送信完了] 宛先 %d 人, メッセージ %d 件", len(user_ids), len(messages))
+                return
+
+            except LineBotApiError as e:
+                # 409は同じリトライキーの送信が受理済みということなので成功とみなす
+                if e.status_code == 409:
+                    metrics.LINE_PUSHES.inc(kind=kind, result="already_accepted")
+                    self._count("sent_requests")
+                    return
+                if (e.status_code == 429 or e.status_code >= 500) and attempt < push_max_retries:
+                    wait_seconds = push_retry_backoff * (2 ** attempt)
+                    logger.warning(f"[通知再試行] status={e.status_code} {attempt + 1}/{push_max_retries} 回目 {wait_seconds:.1f}秒後")
+                    metrics.LINE_PUSHES.inc(kind=kind, result="retry")
+                    time.sleep(wait_seconds)
+                    continue
+                logger.error(f"[定期通知失敗] 宛先 {len(user_ids)} 人 → {e}")
+                break
+
+            except Exception as e:
+                logger.error(f"[定期通知失敗] 宛先 {len(user_ids)} 人 → {e}")
+                break
+
+        metrics.LINE_PUSHES.inc(kind=kind, result="error")
+        self._count("failed_requests")
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
@@ -0,0 +1,152 @@
+# response_cache.py
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import metrics
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+# 短い有効期間のキャッシュ　件数の上限（LRU）付きで、同じキーの取得が同時に来たら1回だけ取りに行く
+# path を渡すとsqliteのファイルにも保存し、ワーカーの再起動後も使えるようにする
+# 値はJSONにできるもの、キーは文字列のタプル
+class ResponseCache:
+
+    def __init__(self, name, ttl_seconds=60, max_size=1024, path=None):
+        self._name = name  # メトリクスのラベル
+        self._ttl = ttl_seconds
+        self._max_size = max_size
+        self._items = OrderedDict()  # key -> (保存時刻, 値)　古い順
+        self._inflight = {}  # key -> Future　取得中のキー
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        if path:
+            self._open_disk(path)
+
+    def _open_disk(self, path):
+        try:
+            disk = sqlite3.connect(path, check_same_thread=False, timeout=5)
+            disk.execute("PRAGMA journal_mode=WAL")
+            disk.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            """)
+            disk.commit()
+            self._disk = disk
+            logger.info(f"[レスポンスキャッシュ] ファイルに保存します: {path}")
+        except sqlite3.Error as e:
+            logger.error(f"[レスポンスキャッシュ] ファイルを開けないためメモリのみで動かします: {e}")
+
+    # キャッシュにあればそれを返し、なければ loader() の結果を保存して返す
+    # 他のスレッドが同じキーを取得中なら、その結果を待って使う　loader() がNoneを返したときは保存しない
+    def get_or_load(self, key, loader):
+        if self._ttl <= 0:
+            return loader()
+
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                metrics.CACHE_HITS.inc(cache=self._name)
+                return value
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if not owner:
+            metrics.CACHE_HITS.inc(cache=self._name, coalesced="true")
+            return future.result()
+
+        try:
+            value = self._get_disk(key)
+            if value is not None:
+                metrics.CACHE_HITS.inc(cache=self._name, disk="true")
+            else:
+                metrics.CACHE_MISSES.inc(cache=self._name)
+                value = loader()
+                if value is not None:
+                    self._put_disk(key, value)
+                    with self._lock:
+                        self._put_memory(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        if self._disk:
+            with self._disk_lock:
+                self._disk.execute("DELETE FROM response_cache")
+                self._disk.commit()
+
+    def _get_memory(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        stored_at, value = item
+        if time.time() - stored_at >= self._ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def _put_memory(self, key, value, stored_at=None):
+        self._items[key] = (stored_at or time.time(), value)
+        self._items.move_to_end(key)
+        while len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+
+    def _get_disk(self, key):
+        if not self._disk:
+            return None
+        try:
+            with self._disk_lock:
+                row = self._disk.execute(
+                    "SELECT value, stored_at FROM response_cache WHERE key = ? AND stored_at > ?",
+                    (json.dumps(key), time.time() - self._ttl)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"[レスポンスキャッシュ] 読み込みエラー: {e}")
+            return None
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        with self._lock:
+            self._put_memory(key, value, row[1])
+        return value
+
+    def _put_disk(self, key, value):
+        if not self._disk:
+            return
+        now = time.time()
+        try:
+            with self._disk_lock:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, stored_at) VALUES (?, ?, ?)",
+                    (json.dumps(key), json.dumps(value), now)
+                )
+                # 期限切れの行と、上限を超えた古い行を消す
+                self._disk.execute("DELETE FROM response_cache WHERE stored_at <= ?", (now - self._ttl,))
+                self._disk.execute("""
+                    DELETE FROM response_cache WHERE key NOT IN (
+                        SELECT key FROM response_cache ORDER BY stored_at DESC LIMIT ?
+                    )
+                """, (self._max_size,))
+                self._disk.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"[レスポンスキャッシュ] 書き込みエラー: {e}")
@@ -0,0 +1,125 @@
+# scan_worker.py
+#
+# scan_jobsテーブルのスキャンジョブを取って処理するワーカー　何台・何プロセスでも並べて動かせる
+# 途中で落ちても、取ったジョブは期限（visibility timeout）が切れると他のワーカーが取り直す
+#
+#   python scan_worker.py                 # ジョブを待ち続けて処理する
+#   python scan_worker.py --once          # 溜まっているジョブを処理し終えたら終了する
+#   python scan_worker.py --enqueue all   # 希望のある全施設のジョブを積む（--enqueue ID ID ... で施設を指定）
+
+from main import main as run_scan
+from db_utils import ensure_schema
+from db_utils import fetch_wished_facilities
+from db_utils import enqueue_scan_jobs
+from db_utils import claim_scan_jobs
+from db_utils import extend_scan_jobs
+from db_utils import complete_scan_jobs
+from db_utils import fail_scan_jobs
+from db_utils import purge_scan_jobs
+from logging_setup import setup_logging
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+# ジョブの設定
+batch_size = int(os.getenv("SCAN_JOB_BATCH_SIZE", "10"))  # 1回に取るジョブ数（施設数）
+visibility_timeout = int(os.getenv("SCAN_JOB_VISIBILITY_TIMEOUT", "600"))  # 秒　これを過ぎても終わらなければ他のワーカーが取り直す
+max_attempts = int(os.getenv("SCAN_JOB_MAX_ATTEMPTS", "3"))  # 失敗したときの試行回数の上限
+retry_delay = float(os.getenv("SCAN_JOB_RETRY_DELAY", "60"))  # 秒　失敗するたびに倍になる
+poll_interval = float(os.getenv("SCAN_JOB_POLL_INTERVAL", "5"))  # 秒　ジョブがないときの待ち時間
+retention = int(os.getenv("SCAN_JOB_RETENTION", "604800"))  # 秒　終わったジョブを残しておく期間
+
+_stopping = threading.Event()
+
+# ジョブを最大limit件取って、その施設をまとめて1回スキャンする　戻り値: 取ったジョブ数
+def process_batch(worker_id, limit):
+    jobs = claim_scan_jobs(worker_id, limit, visibility_timeout)
+    if not jobs:
+        return 0
+
+    # 処理中は期限を延ばし続ける
+    stop_heartbeat = threading.Event()
+
+    def heartbeat():
+        while not stop_heartbeat.wait(visibility_timeout / 3):
+            extend_scan_jobs([job["id"] for job in jobs], worker_id, visibility_timeout)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    try:
+        summary = run_scan(list(dict.fromkeys(job["facility_id"] for job in jobs)))
+    except Exception as e:
+        logger.error(f"[ジョブ処理エラー] worker={worker_id}: {e}")
+        fail_scan_jobs([job["id"] for job in jobs], worker_id, e, retry_delay)
+        return len(jobs)
+    finally:
+        stop_heartbeat.set()
+
+    # 取得できなかった月がある施設のジョブだけ再実行に回す
+    failed_ids = set(summary["failed_facility_ids"])
+    failed_jobs = [job["id"] for job in jobs if job["facility_id"] in failed_ids]
+    done_jobs = [job["id"] for job in jobs if job["facility_id"] not in failed_ids]
+    if failed_jobs:
+        fail_scan_jobs(failed_jobs, worker_id, "カレンダーを取得できない月がありました", retry_delay)
+    if done_jobs:
+        complete_scan_jobs(done_jobs, worker_id)
+    return len(jobs)
+
+def run_worker(limit, once=False):
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    logger.info(f"[ワーカー起動] worker={worker_id}, 1回 {limit} 件, 期限 {visibility_timeout} 秒")
+
+    last_purged = 0.0
+    while not _stopping.is_set():
+        if time.monotonic() - last_purged > 3600:
+            purged = purge_scan_jobs(retention)
+            if purged:
+                logger.info(f"[ジョブ掃除] {purged} 件を削除")
+            last_purged = time.monotonic()
+
+        if process_batch(worker_id, limit):
+            continue
+        if once:
+            break
+        _stopping.wait(poll_interval)
+
+    logger.info(f"[ワーカー停止] worker={worker_id}")
+
+# 停止の合図を受けたら、処理中のジョブを終えてから止まる
+def request_stop(signum, frame):
+    logger.info(f"[停止要求] signal={signum} 処理中のジョブを終えたら停止します")
+    _stopping.set()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スキャンジョブのワーカー")
+    parser.add_argument("--batch-size", type=int, default=batch_size, help="1回に取るジョブ数")
+    parser.add_argument("--once", action="store_true", help="ジョブがなくなったら終了する")
+    parser.add_argument("--enqueue", nargs="+", metavar="FACILITY_ID", help="ジョブを積んで終了する（all で希望のある全施設）")
+    args = parser.parse_args(argv)
+    setup_logging()
+    if not ensure_schema():  # scan_jobsテーブルなどを最初に作っておく
+        logger.error("DBスキーマを準備できないため終了します")
+        return 1
+
+    if args.enqueue:
+        if args.enqueue == ["all"]:
+            facility_ids = [row["facility_id"] for row in fetch_wished_facilities()]
+        else:
+            facility_ids = args.enqueue
+        return 0 if enqueue_scan_jobs(facility_ids, max_attempts) is not None else 1
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    run_worker(args.batch_size, args.once)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
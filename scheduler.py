@@ -0,0 +1,166 @@
+# scheduler.py
+
+from db_utils import ensure_schema
+from db_utils import fetch_scan_candidates
+from db_utils import enqueue_scan_jobs
+from db_utils import refill_scan_budget
+from db_utils import spend_scan_budget
+from main import run_scan_once
+from scraper import SCAN_MONTHS
+from scraper import bookable_months
+from wish_conditions import union_months
+from datetime import date
+import math
+import time
+import logging
+import os
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+# 施設ごとのスキャン間隔の設定（秒）
+tick_seconds = int(os.getenv("SCHEDULER_TICK_SECONDS", "60"))  # スキャンが必要な施設を探す間隔
+base_interval = int(os.getenv("SCAN_BASE_INTERVAL", "43200"))  # 希望者1人・変化なし・近い空きなしの施設の間隔（従来の1日2回）
+min_poll_interval = int(os.getenv("SCAN_MIN_POLL_INTERVAL", "900"))  # どんなに人気の施設でもこれより短くしない
+max_poll_interval = int(os.getenv("SCAN_MAX_POLL_INTERVAL", "43200"))  # どんなに静かな施設でもこれより長くしない
+hourly_request_budget = int(os.getenv("SCAN_HOURLY_REQUEST_BUDGET", "120"))  # its-kenpoへの1時間あたりのリクエスト上限
+# 溜めておけるリクエスト数　ホストが止まっていた間の分もここまではまとめて使える（既定は1時間ぶん）
+budget_capacity = int(os.getenv("SCAN_BUDGET_CAPACITY", str(hourly_request_budget)))
+use_job_queue = os.getenv("SCAN_USE_JOB_QUEUE", "0") == "1"  # 1ならこのプロセスではスキャンせず、scan_jobsに積んでscan_worker.pyに任せる
+job_max_attempts = int(os.getenv("SCAN_JOB_MAX_ATTEMPTS", "3"))
+
+# リクエストの残り回数はscan_budgetsに置き、全プロセス（gunicornのワーカー、scan_worker.pyを積む側）で共有する
+BUDGET_NAME = "its_kenpo_requests"
+
+# 希望者数・最近の変化の多さ・空き日の近さから、1施設のスキャン間隔（秒）を決める
+def compute_poll_interval(subscribers, change_rate, days_until_nearest):
+    interval = base_interval / (1 + math.log2(max(subscribers, 1)))  # 希望者が倍になるごとに短くする
+    interval /= 1 + 3 * change_rate  # 空きがよく動く施設ほど短くする
+
+    # 近い日程の空きはすぐ埋まるので、こまめに見る
+    if days_until_nearest is not None:
+        if days_until_nearest <= 7:
+            interval *= 0.5
+        elif days_until_nearest <= 30:
+            interval *= 0.75
+
+    return min(max(interval, min_poll_interval), max_poll_interval)
+
+# 今日以降でいちばん近い空き日までの日数　なければNone
+def days_until_nearest(available_dates, today):
+    upcoming = [date.fromisoformat(d) for d in available_dates if d >= today.isoformat()]
+    if not upcoming:
+        return None
+    return (min(upcoming) - today).days
+
+# 全施設の間隔を決め、その間隔で回し続けても1時間のリクエスト上限に収まるよう一律に引き伸ばす
+# 戻り値: {facility_id: 間隔（秒）}
+def plan_poll_intervals(candidates, today=None):
+    today = today or date.today()
+    intervals = {
+        candidate["facility_id"]: compute_poll_interval(
+            candidate["subscribers"],
+            candidate["change_rate"],
+            days_until_nearest(candidate["available_dates"], today)
+        )
+        for candidate in candidates
+    }
+
+    hourly_requests = sum(candidate["months"] * 3600 / intervals[candidate["facility_id"]] for candidate in candidates)
+    if hourly_requests > hourly_request_budget:
+        stretch = hourly_requests / hourly_request_budget
+        logger.info(f"[スキャン間隔調整] 予定 {hourly_requests:.0f} 件/時 > 上限 {hourly_request_budget} 件/時 → 間隔を {stretch:.2f} 倍")
+        intervals = {facility_id: interval * stretch for facility_id, interval in intervals.items()}
+
+    return intervals
+
+# 間隔を過ぎた施設を、遅れの大きい順（一度もスキャンしていない施設が先頭）に最大limit件返す
+def select_due_facilities(candidates, intervals, limit):
+    due = []
+    for candidate in candidates:
+        age = candidate["age_seconds"]
+        interval = intervals[candidate["facility_id"]]
+        if age is None:
+            due.append((math.inf, candidate["facility_id"]))
+        elif age >= interval:
+            due.append((age / interval, candidate["facility_id"]))
+
+    due.sort(reverse=True)
+    return [facility_id for _, facility_id in due[:limit]]
+
+# 上限から補充したリクエスト数のうち、今回使える数（DBエラーのときは0）
+# 未スキャンの施設が多いときに、溜めた分を超えてまとめて取りに行かないようにする
+def _affordable_requests():
+    tokens = refill_scan_budget(BUDGET_NAME, hourly_request_budget, max(budget_capacity, SCAN_MONTHS))  # 最低でも1施設ぶんは溜める
+    return max(int(tokens), 0) if tokens is not None else 0
+
+def _spend(request_count):
+    spend_scan_budget(BUDGET_NAME, request_count)
+
+# 希望者の条件から、各施設で取りに行く月数（main.plan_facility_scans と同じ計算）を candidate["months"] に入れる
+# 条件の期間がどれも予約できる範囲の外にある施設は、スキャンしても何も取りに行かないので除く
+def _attach_months(candidates):
+    months = bookable_months()
+    for candidate in candidates:
+        candidate["months"] = len(union_months(candidate["conditions"], months))
+    return [candidate for candidate in candidates if candidate["months"]]
+
+# 1回分の判定と実行　スキャンが必要な施設だけを run_scan_once に渡す（ジョブキューを使う設定ならscan_jobsに積む）
+# 戻り値: "idle"（対象なし） / "throttled"（上限待ち） / "enqueued"（ジョブを積んだ） / run_scan_once の戻り値
+def run_adaptive_tick(trigger):
+    ensure_schema()  # 候補の取得にchange_rateの列を使うため、スキャンより先にスキーマを揃える
+    candidates = _attach_months(fetch_scan_candidates())
+    if not candidates:
+        return "idle"
+
+    intervals = plan_poll_intervals(candidates)
+    due = select_due_facilities(candidates, intervals, len(candidates))
+    if not due:
+        return "idle"
+
+    # 遅れの大きい順に、取りに行く月数の合計が使えるリクエスト数に収まるところまで
+    months = {candidate["facility_id"]: candidate["months"] for candidate in candidates}
+    affordable = _affordable_requests()
+    facility_ids = []
+    planned = 0
+    for facility_id in due:
+        if planned + months[facility_id] > affordable:
+            break
+        facility_ids.append(facility_id)
+        planned += months[facility_id]
+
+    if not facility_ids:
+        logger.info(f"[スキャン待ち] trigger={trigger} 対象 {len(due)} 件 リクエスト上限のため次回に回します")
+        return "throttled"
+
+    logger.info(
+        f"[スキャン対象] trigger={trigger} {len(facility_ids)}/{len(due)} 件 ページ {planned} 件"
+        f"（希望のある施設 {len(candidates)} 件）"
+    )
+    if use_job_queue:
+        # 前回積んだジョブがまだ終わっていない施設は積まれないので、その分は使わない
+        enqueued = enqueue_scan_jobs(facility_ids, job_max_attempts)
+        if enqueued:
+            _spend(sum(months[facility_id] for facility_id in enqueued))
+        return "enqueued"
+
+    # 他のプロセスが直前に同じ判定で実行していたら、そちらに任せる
+    status = run_scan_once(trigger, facility_ids=facility_ids, min_interval=tick_seconds / 2)
+    if status == "completed":
+        _spend(planned)
+    return status
+
+# 定期実行用のループ　tick_seconds ごとにスキャンが必要な施設を探す
+def scheduler_loop():
+    logger.info(
+        f"[スケジューラ起動] 間隔 {tick_seconds} 秒, 上限 {hourly_request_budget} 件/時（最大 {budget_capacity} 件まで溜める）, "
+        f"施設ごとの間隔 {min_poll_interval}〜{max_poll_interval} 秒"
+    )
+    while True:
+        time.sleep(tick_seconds)
+        try:
+            status = run_adaptive_tick("scheduled")  # 他のワーカーが実行した場合はスキップされる
+            if status not in ("idle", "skipped", "enqueued"):
+                logger.info(f"定期実行完了: {status}")
+        except Exception as e:
+            logger.error(f"実行エラー: {e}")
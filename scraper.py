@@ -1,28 +1,188 @@
 # scraper.py
 
-from bs4 import BeautifulSoup
 from urllib.parse import quote
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from calendar_parser import parse_available_dates, calendar_fingerprint, CalendarParseError
+from message_renderer import render_availability
+from response_cache import ResponseCache
+from logging_setup import log_summary
+import metrics
 import re
+import os
+import time
+import hashlib
 import logging
+import threading
 import requests
 
 # ロガー設定
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+# スクレイピング先　ベンチマークなどでローカルの代替サーバーに向けるときだけ変える
+KENPO_BASE_URL = os.getenv("ITS_KENPO_BASE_URL", "https://as.its-kenpo.or.jp").rstrip("/")
+
+# its-kenpoへのHTTP設定　相手先に負荷をかけすぎないよう同時接続数に上限を設ける
+max_concurrency = int(os.getenv("SCRAPER_MAX_CONCURRENCY", "4"))  # as.its-kenpo.or.jp への同時リクエスト上限
+request_timeout = float(os.getenv("SCRAPER_TIMEOUT", "10"))  # 1リクエストあたりのタイムアウト（秒）
+max_retries = int(os.getenv("SCRAPER_MAX_RETRIES", "3"))  # 失敗時の再試行回数
+retry_backoff = float(os.getenv("SCRAPER_RETRY_BACKOFF", "0.5"))  # 再試行の待ち時間の基準（秒）、回数ごとに倍になる
+SCAN_MONTHS = int(os.getenv("SCAN_LOOKAHEAD_MONTHS", "3"))  # 1施設あたり今月から何か月分のカレンダーを見るか（= 1施設のスキャンにかかる最大リクエスト数）
+booking_window_days = int(os.getenv("SCAN_BOOKING_WINDOW_DAYS", "0"))  # 今日から何日先まで予約を受け付けているか　これより先の月は取りに行かない（0なら制限なし）
+
+# 再試行する価値のあるステータスコード
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 施設一覧のキャッシュ設定　施設の増減はまれなので、有効期間内は取りに行かない
+facility_catalog_ttl = int(os.getenv("FACILITY_CATALOG_TTL", "86400"))  # 秒
+
+# 施設一覧ページのうち施設タブの部分　ページ全体はカレンダーを含み毎回変わるため、ここだけでハッシュを取る
+TOP_TABS_RE = re.compile(rb"<ul[^>]*\bid=[\"']?top_tabs\b.*?</ul\s*>", re.IGNORECASE | re.DOTALL)
+
+# カレンダーページのキャッシュ設定　定期スキャンと「空き確認」が同じ施設・同じ月を続けて取りに行かないようにする
+calendar_cache = ResponseCache(
+    "calendar_response",
+    ttl_seconds=int(os.getenv("SCRAPER_CACHE_TTL", "60")),  # 秒　0ならキャッシュしない
+    max_size=int(os.getenv("SCRAPER_CACHE_SIZE", "1024")),  # 件（施設×月）
+    path=os.getenv("SCRAPER_CACHE_PATH")  # sqliteファイルのパス　未設定ならメモリのみ
+)
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphore = threading.BoundedSemaphore(max_concurrency)
+
+_catalog_lock = threading.Lock()
+_catalog_cache = {
+    "url": None,
+    "fetched_at": 0.0,  # time.monotonic()
+    "etag": None,
+    "last_modified": None,
+    "content_hash": None,
+    "facilities": []
+}
+
+# keep-aliveで接続を使いまわすため、プロセス内で1つのSessionを共有する
+def get_http_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+# 共有Sessionでページを取得する　同時実行数の上限、タイムアウト、指数バックオフ付きの再試行を行う
+# 最終的に失敗した場合は requests.RequestException を送出する
+def fetch_page(url, params=None, headers=None):
+    session = get_http_session()
+
+    for attempt in range(max_retries + 1):
+        wait_seconds = retry_backoff * (2 ** attempt)
+        try:
+            with _host_semaphore:
+                metrics.HTTP_REQUESTS.inc()
+                response = session.get(url, params=params, headers=headers, timeout=request_timeout)
+
+            if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    wait_seconds = max(wait_seconds, int(retry_after))
+                logger.warning(f"[再試行] status={response.status_code} {attempt + 1}/{max_retries} 回目 {wait_seconds:.1f}秒後: {url}")
+                metrics.HTTP_RETRIES.inc(reason=str(response.status_code))
+                time.sleep(wait_seconds)
+                continue
+
+            response.raise_for_status()
+            return response
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                metrics.HTTP_ERRORS.inc(reason=type(e).__name__)
+                raise
+            logger.warning(f"[再試行] {e} {attempt + 1}/{max_retries} 回目 {wait_seconds:.1f}秒後: {url}")
+            metrics.HTTP_RETRIES.inc(reason=type(e).__name__)
+            time.sleep(wait_seconds)
+
+        except requests.HTTPError:
+            metrics.HTTP_ERRORS.inc(reason=str(response.status_code))
+            raise
+
 def scrape_facility_names_ids(url):
     logger.info(f'施設名、施設ID取得スクレイピング開始:{url}')
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        logger.info('ページの取得に成功しました')
-    except requests.RequestException as e:
-        logger.error(f'ページ取得エラー:{e}')
-        return []
-    
-    soup = BeautifulSoup(response.text, 'html.parser')
+    with metrics.CATALOG_FETCH_SECONDS.time():
+        try:
+            response = fetch_page(url)
+            logger.info('ページの取得に成功しました')
+        except requests.RequestException as e:
+            logger.error(f'ページ取得エラー:{e}')
+            return []
+
+        return parse_facility_names_ids(response.text)
+
+# 施設一覧をキャッシュ付きで取得する
+# 有効期間内は取得せず、期限切れでも条件付きリクエスト(ETag/Last-Modified)と施設タブ部分のハッシュで変化を判定する
+# 戻り値: (施設リスト, 前回から変わったか)
+def refresh_facility_catalog(url, force=False):
+    with _catalog_lock:
+        cache = _catalog_cache
+        same_url = cache["url"] == url
+        if same_url and not force and time.monotonic() - cache["fetched_at"] < facility_catalog_ttl:
+            logger.info(f"[施設一覧キャッシュ] 有効期間内のため取得を省略 ({len(cache['facilities'])} 件)")
+            metrics.CACHE_HITS.inc(cache="facility_catalog")
+            return cache["facilities"], False
+        metrics.CACHE_MISSES.inc(cache="facility_catalog")
+        fetch_started = time.perf_counter()
+
+        headers = {}
+        if same_url and cache["etag"]:
+            headers["If-None-Match"] = cache["etag"]
+        if same_url and cache["last_modified"]:
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+        logger.info(f'施設名、施設ID取得スクレイピング開始:{url}')
+        try:
+            response = fetch_page(url, headers=headers)
+        except requests.RequestException as e:
+            # 取得できないときは手元の一覧で続ける
+            logger.error(f'ページ取得エラー:{e}')
+            return cache["facilities"], False
+
+        cache["fetched_at"] = time.monotonic()
+        metrics.CATALOG_FETCH_SECONDS.observe(time.perf_counter() - fetch_started)
+        if response.status_code == 304:
+            logger.info("[施設一覧キャッシュ] 304 Not Modified")
+            return cache["facilities"], False
+
+        cache["etag"] = response.headers.get("ETag")
+        cache["last_modified"] = response.headers.get("Last-Modified")
+
+        top_tabs = TOP_TABS_RE.search(response.content)
+        content_hash = hashlib.sha256(top_tabs.group(0) if top_tabs else response.content).hexdigest()
+        if same_url and content_hash == cache["content_hash"]:
+            logger.info("[施設一覧キャッシュ] 内容に変化がないため解析を省略")
+            return cache["facilities"], False
+
+        facilities = parse_facility_names_ids(response.text)
+        if not facilities:
+            # メンテナンス画面などで一覧が取れなかったときは、前回の一覧を残す
+            logger.warning("[施設一覧キャッシュ] 施設を抽出できなかったため前回の一覧を使います")
+            return cache["facilities"], False
+        cache.update({"url": url, "content_hash": content_hash, "facilities": facilities})
+        return facilities, True
+
+# 次回のrefresh_facility_catalogで必ず取り直させる（DBへの保存に失敗したときなど）
+def invalidate_facility_catalog():
+    with _catalog_lock:
+        _catalog_cache.update({"fetched_at": 0.0, "etag": None, "last_modified": None, "content_hash": None})
+
+# 施設一覧ページのHTMLから施設名と施設IDを抜き出す
+def parse_facility_names_ids(html):
+    from bs4 import BeautifulSoup  # 施設一覧の更新時にしか使わないので、使うときに読み込む
+    soup = BeautifulSoup(html, 'html.parser')
     facilities = []
 
     logger.info('施設情報の抽出を開始します')
@@ -33,7 +193,7 @@ def scrape_facility_names_ids(url):
             match = re.search(r's=([A-Za-z0-9]+)', href)
             facility_id = match.group(1) if match else None
             facility_name = span.text.strip()
-            logger.debug(f'抽出された施設: ID={facility_id}, 名前={facility_name}')
+            logger.debug('抽出された施設: ID=%s, 名前=%s', facility_id, facility_name)
             facilities.append({'id': facility_id, 'name': facility_name})
         else:
             logger.warning('不完全な<li>要素が検出されました。')
@@ -43,63 +203,174 @@ def scrape_facility_names_ids(url):
 
 def scrape_avl_from_calender(facility_id, facility_name, user_id, is_manual):
     logger.info(f"[関数呼び出し] scrape_avl_from_calender → facility_id={facility_id}, name={facility_name}, user_id={user_id}")
-    
+
+    available_dates = fetch_available_dates(facility_id, facility_name)
+    message = format_availability_message(facility_id, facility_name, available_dates, is_manual)
+    if not message:
+        logger.info(f" 定期実行：空きなし → facility_name={facility_name}, user_id={user_id}")
+    return message
+
+# 施設のカレンダーを予約できる範囲の月だけ取得し、空き日（YYYY-MM-DD）を昇順のリストで返す
+# 施設ごとに1回だけ呼べば、結果を希望者全員で使いまわせる
+def fetch_available_dates(facility_id, facility_name):
+    results = scan_facilities([{"facility_id": facility_id, "facility_name": facility_name}])
+    return results[facility_id]["available_dates"]
+
+# 今月からSCAN_MONTHSか月のうち、予約を受け付けている範囲にかかる月の1日を返す
+def bookable_months(today=None):
+    today = today or datetime.now()
+    base_date = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    window_end = today + timedelta(days=booking_window_days) if booking_window_days > 0 else None
+
+    months = []
+    for i in range(SCAN_MONTHS):
+        year, month = divmod(base_date.month - 1 + i, 12)
+        first_day = base_date.replace(year=base_date.year + year, month=month + 1)
+        if window_end and first_day > window_end:
+            break
+        months.append(first_day)
+    return months
+
+# 複数施設×予約できる月のカレンダーを並列に取得する
+# 施設に "months"（各月の1日のリスト）があればその月だけを取りに行く（希望者の条件で要らない月を省く）
+# fingerprints（前回の施設×月ごとの指紋）を渡すと条件付きリクエストを行い、変わっていない月は解析を省く
+# 戻り値: {facility_id: {"available_dates": [...], "scanned_months": 取得できた月, "failed_months": [...],
+#                        "unchanged": 全月とも前回と同じか, "fingerprints": {"YYYY-MM": 保存し直す指紋}}}
+def scan_facilities(facilities, fingerprints=None):
+    fingerprints = fingerprints or {}
     today = datetime.now()
-    base_date = today.replace(day=1)
-    all_available_dates = set()  # 重複排除のため set を使用
+    today_str = today.strftime("%Y-%m-%d")
+    all_months = bookable_months(today)
 
-    for i in range(3):
-        first_day = base_date + relativedelta(months=i)
-        target_year = first_day.year
-        target_month = first_day.month
+    jobs = []
+    for facility in facilities:
+        previous = fingerprints.get(facility["facility_id"], {})
+        months = facility.get("months")
+        for first_day in all_months if months is None else months:
+            jobs.append((facility["facility_id"], facility["facility_name"], first_day, previous.get(first_day.strftime("%Y-%m"))))
 
-        logger.info(f"[{facility_name}] {target_year}年{target_month}月 スクレイピング開始")
-        
-        base_url = "https://as.its-kenpo.or.jp/apply/empty_calendar" # 本番用
-                # "https://linebottester.github.io/kenpo_test_site/test_calendar.html" # !!!!!test用!!!!!
-                # https://as.its-kenpo.or.jp/apply/calendar3 # こちらでは認証ページに遷移してしまう
-
-                # Urlの変数部分を定義する　パラメータがすべて空だと保養施設の案内ページに行く
-        params = {
-            's': facility_id, #　各施設のID（と思しき変数）# テスト時はずす
-            # 'join_date': first_day.strftime("%Y-%m-%d"), 
-            'join_date': first_day,#'2025-07-01', # スクレイピングを行う月を指定する,空の時は今月を見に行くようだ
-            'night_count':'' # 泊数をしているようだが効いていないように見える
+    results = {
+        facility["facility_id"]: {  # 重複排除のため set を使用
+            "available_dates": set(), "scanned_months": [], "failed_months": [], "unchanged": True, "fingerprints": {}
         }
+        for facility in facilities
+    }
 
-        try:
-            response = requests.get(base_url, params=params)
-            response.raise_for_status()
-            logger.info(f"{target_year}年{target_month}月の施設名:{facility_name}, 施設ID:{facility_id}に対するページ取得成功")
-            soup = BeautifulSoup(response.content, "html.parser")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [(job, executor.submit(fetch_calendar_month, *job)) for job in jobs]
 
-            # 月単位の空き日を抽出し、重複排除セットに追加
-            dates = extract_available_dates(soup, facility_id)
-            all_available_dates.update(dates)
+        for (facility_id, facility_name, first_day, previous), future in futures:
+            result = results[facility_id]
+            month = future.result()
+            if month is None:
+                result["failed_months"].append(first_day.strftime("%Y-%m"))
+                result["unchanged"] = False
+                continue
 
-        except requests.RequestException as e:
-            logger.error(f"{target_year}年{target_month}月の施設名:{facility_name}, 施設ID:{facility_id} の取得に失敗: {e}")
+            # 月単位の空き日を重複排除セットに追加　今月の過ぎた日は除く
+            result["scanned_months"].append(first_day.strftime("%Y-%m"))
+            result["available_dates"].update(d for d in month["available_dates"] if d >= today_str)
+            if month["changed"]:
+                result["unchanged"] = False
+            if previous is None or any(month[key] != previous[key] for key in ("content_hash", "etag", "last_modified")):
+                result["fingerprints"][first_day.strftime("%Y-%m")] = {
+                    key: month[key] for key in ("content_hash", "etag", "last_modified", "available_dates")
+                }
 
-    # 全体の空き日をまとめて通知
-    calendar_url = f"https://as.its-kenpo.or.jp/apply/empty_calendar?s={facility_id}"
+    for result in results.values():
+        result["available_dates"] = sorted(result["available_dates"])
 
-    if not all_available_dates:
-        if is_manual:
-            return f"{facility_name}には現在予約可能な日程がありません。"
-        else:
-            logger.info(f" 定期実行：空きなし → facility_name={facility_name}, user_id={user_id}")
-            return ""
-    
-    formatted_dates = [
-        f"{datetime.strptime(d, '%Y-%m-%d').month}月{datetime.strptime(d, '%Y-%m-%d').day}日（{'月火水木金土日'[datetime.strptime(d, '%Y-%m-%d').weekday()]})"
-        for d in sorted(all_available_dates)
-    ]
-
-    return (
-        f"{facility_name}の次の日程に空きがあります。\n"
-        + "、".join(formatted_dates)
-        + f"\n\n予約ページはこちら：{calendar_url}"
+    log_summary(logger, "スキャン完了", {
+        "facilities": len(facilities),
+        "unchanged_facilities": sum(1 for result in results.values() if result["unchanged"]),
+        "pages": len(jobs),
+        "failed_months": sum(len(result["failed_months"]) for result in results.values()),
+        "available_dates": sum(len(result["available_dates"]) for result in results.values()),
+        "seconds": time.monotonic() - started
+    })
+    return results
+
+# 1施設1か月分のカレンダーを取得して空き日と指紋を返す　取得に失敗した場合は None
+# 短い間に同じ施設・同じ月を取りに来たらキャッシュを使い、同時に来たら1回の取得を共有する
+# 戻り値: {"available_dates", "content_hash", "etag", "last_modified", "changed": previous（前回の指紋）から変わったか}
+def fetch_calendar_month(facility_id, facility_name, first_day, previous=None):
+    month = calendar_cache.get_or_load(
+        (facility_id, first_day.strftime("%Y-%m-%d")),
+        lambda: load_calendar_month(facility_id, facility_name, first_day, previous)
     )
+    if month is None:
+        return None
+    return dict(month, changed=previous is None or month["content_hash"] != previous["content_hash"])
+
+# its-kenpoから1施設1か月分のカレンダーを取得する
+# previousがあれば条件付きリクエストを行い、304や内容が同じときは解析せず前回の空き日を返す
+def load_calendar_month(facility_id, facility_name, first_day, previous=None):
+    target_year = first_day.year
+    target_month = first_day.month
+
+    logger.debug("[%s] %d年%d月 スクレイピング開始", facility_name, target_year, target_month)
+    
+    base_url = f"{KENPO_BASE_URL}/apply/empty_calendar" # 本番用
+            # "https://linebottester.github.io/kenpo_test_site/test_calendar.html" # !!!!!test用!!!!!
+            # https://as.its-kenpo.or.jp/apply/calendar3 # こちらでは認証ページに遷移してしまう
+
+            # Urlの変数部分を定義する　パラメータがすべて空だと保養施設の案内ページに行く
+    params = {
+        's': facility_id, #　各施設のID（と思しき変数）# テスト時はずす
+        # 'join_date': first_day.strftime("%Y-%m-%d"), 
+        'join_date': first_day,#'2025-07-01', # スクレイピングを行う月を指定する,空の時は今月を見に行くようだ
+        'night_count':'' # 泊数をしているようだが効いていないように見える
+    }
+
+    headers = {}
+    if previous and previous["etag"]:
+        headers["If-None-Match"] = previous["etag"]
+    if previous and previous["last_modified"]:
+        headers["If-Modified-Since"] = previous["last_modified"]
+
+    try:
+        with metrics.CALENDAR_FETCH_SECONDS.time():
+            response = fetch_page(base_url, params=params, headers=headers)
+        logger.debug("%d年%d月の施設名:%s, 施設ID:%s に対するページ取得成功", target_year, target_month, facility_name, facility_id)
+
+    except requests.RequestException as e:
+        logger.error(f"{target_year}年{target_month}月の施設名:{facility_name}, 施設ID:{facility_id} の取得に失敗: {e}")
+        return None
+
+    if previous and response.status_code == 304:
+        metrics.CACHE_HITS.inc(cache="calendar_month")
+        return {key: previous[key] for key in ("content_hash", "etag", "last_modified", "available_dates")}
+
+    content_hash = calendar_fingerprint(response.content)
+    month = {
+        "content_hash": content_hash,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified")
+    }
+    if previous and content_hash == previous["content_hash"]:
+        metrics.CACHE_HITS.inc(cache="calendar_month")
+        return dict(month, available_dates=previous["available_dates"])
+
+    metrics.CACHE_MISSES.inc(cache="calendar_month")
+    return dict(month, available_dates=parse_calendar_page(response.content, facility_id))
+
+# 空き日リストから通知文を作る　空きがない場合、定期実行では空文字を返す
+def format_availability_message(facility_id, facility_name, available_dates, is_manual):
+    calendar_url = f"{KENPO_BASE_URL}/apply/empty_calendar?s={facility_id}"
+    return render_availability(facility_name, calendar_url, tuple(available_dates), is_manual)
+
+# カレンダーページから空き日を抜き出す　通常は高速パーサーを使い、解釈できないページだけBeautifulSoupで読む
+def parse_calendar_page(content, facility_id):
+    try:
+        with metrics.CALENDAR_PARSE_SECONDS.time(parser="fast"):
+            return parse_available_dates(content, facility_id)
+    except CalendarParseError as e:
+        logger.warning(f"[高速パーサー失敗] {facility_id}: {e} → BeautifulSoupで再解析します")
+        with metrics.CALENDAR_PARSE_SECONDS.time(parser="bs4"):
+            from bs4 import BeautifulSoup  # 高速パーサーで読めないページのときだけ読み込む
+            soup = BeautifulSoup(content, "html.parser")
+            return extract_available_dates(soup, facility_id)
 
 def extract_available_dates(soup, facility_id):
     logger = logging.getLogger(__name__)
@@ -111,36 +382,19 @@ def extract_available_dates(soup, facility_id):
             status_text = status_icon.get_text(strip=True)
             join_date = td["data-join-time"]
             if status_text != "☓":
-                logger.info(f"空きあり: {facility_id} {join_date} 状態: {status_text}")
+                logger.debug("空きあり: %s %s 状態: %s", facility_id, join_date, status_text)
                 available_dates.append(join_date)
             else:
-                logger.debug(f"満室: {facility_id} {join_date} 状態: {status_text}")
+                logger.debug("満室: %s %s 状態: %s", facility_id, join_date, status_text)
     return available_dates
 
 def notify_user_about_dates(date_list, facility_name, facility_id, user_id, calendar_url):
     from line_bot_server import notify_user
     logger = logging.getLogger(__name__)
 
+    notify_text = render_availability(facility_name, calendar_url, tuple(date_list), True)
+    notify_user(user_id, notify_text)
     if not date_list:
-        notify_text = f"{facility_name}には現在予約可能な日程がありません。"
-        notify_user(user_id, notify_text)
         logger.info(f"{facility_id} に空きなし通知を送信 → {notify_text}")
-        return
-
-    formatted_dates = []
-    for date_str in date_list:
-        dt = datetime.strptime(date_str, "%Y-%m-%d")
-        weekday = "月火水木金土日"[dt.weekday()]
-        formatted_dates.append(f"{dt.month}月{dt.day}日（{weekday}）")
-
-    notify_text = (
-        f"{facility_name}の次の日程に空きがあります。\n"
-        + "、".join(formatted_dates)
-        + f"\n\n予約ページはこちら：{calendar_url}"
-    )
-    notify_user(user_id, notify_text)
-    logger.info(f"{facility_id} に空き通知を送信 → {notify_text}")
-
-
-
-        
\ No newline at end of file
+    else:
+        logger.info(f"{facility_id} に空き通知を送信 → {notify_text}")
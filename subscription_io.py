@@ -0,0 +1,179 @@
+# subscription_io.py
+#
+# users / user_wishes をCSVまたはJSONLで書き出し・読み込みする（チャネルの移行やバックアップからの復元用）
+# どちらも1行ずつ流しながら処理し、読み込みはbatch_size行ごとに1トランザクションでまとめて登録する
+#
+#   python subscription_io.py export user_wishes --format jsonl -o wishes.jsonl
+#   python subscription_io.py import user_wishes wishes.jsonl
+#   python subscription_io.py import user_wishes cancel.csv --cancel
+#   python subscription_io.py export users > users.csv
+
+from db_utils import ensure_schema
+from db_utils import iter_export_rows
+from db_utils import register_users
+from db_utils import register_user_selections
+from db_utils import cancel_user_selections
+from db_utils import BATCH_PAGE_SIZE
+from logging_setup import setup_logging
+from datetime import date
+from itertools import islice
+import argparse
+import csv
+import json
+import logging
+import sys
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+# テーブルごとの列
+COLUMNS = {
+    "users": ["user_id"],
+    "user_wishes": ["user_id", "facility_id", "created_at", "date_from", "date_to", "weekdays", "min_nights"]
+}
+
+def _to_text(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+def export_rows(table, out, fmt, batch_size=BATCH_PAGE_SIZE):
+    columns = COLUMNS[table]
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+
+    count = 0
+    for row in iter_export_rows(table, batch_size):
+        row = {column: _to_text(row[column]) for column in columns}
+        if writer:
+            writer.writerow(row)
+        else:
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        count += 1
+
+    logger.info(f"[書き出し完了] {table} {count} 件")
+    return count
+
+def read_rows(src, fmt):
+    if fmt == "csv":
+        yield from csv.DictReader(src)
+        return
+    for line_number, line in enumerate(src, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            logger.warning(f"[読み飛ばし] {line_number} 行目をJSONとして読めません: {e}")
+
+# 1行を登録・解除に渡す形にする　必要な列がない行はNone
+def _to_record(table, row):
+    user_id = str(row.get("user_id") or "").strip()
+    if not user_id:
+        return None
+    if table == "users":
+        return user_id
+
+    facility_id = str(row.get("facility_id") or "").strip()
+    if not facility_id:
+        return None
+    try:
+        conditions = _to_conditions(row)
+    except ValueError as e:
+        logger.warning(f"[読み飛ばし] user_id={user_id}, facility_id={facility_id} の条件が読めません: {e}")
+        return None
+    return (user_id, facility_id, row.get("created_at") or None, conditions)
+
+# 通知条件の列　CSVでは空文字、古い形式のファイルでは列自体がないので、どちらも条件なしとして扱う
+def _to_conditions(row):
+    values = {column: str(row.get(column) or "").strip() or None for column in ("date_from", "date_to", "weekdays", "min_nights")}
+    for column in ("date_from", "date_to"):
+        if values[column]:
+            values[column] = date.fromisoformat(values[column]).isoformat()
+    return {
+        "date_from": values["date_from"],
+        "date_to": values["date_to"],
+        "weekdays": int(values["weekdays"]) if values["weekdays"] else None,
+        "min_nights": int(values["min_nights"]) if values["min_nights"] else 1
+    }
+
+def import_rows(table, src, fmt, cancel=False, batch_size=BATCH_PAGE_SIZE):
+    rows = read_rows(src, fmt)
+    total = {"read": 0, "skipped": 0, "applied": 0, "failed_batches": 0}
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        records = []
+        for row in batch:
+            record = _to_record(table, row)
+            if record is None:
+                total["skipped"] += 1
+            else:
+                records.append(record)
+        total["read"] += len(batch)
+
+        if table == "users":
+            applied = register_users(records)
+        elif cancel:
+            applied = cancel_user_selections(records)
+        else:
+            applied = register_user_selections(records)
+
+        if applied is None:
+            total["failed_batches"] += 1
+        else:
+            total["applied"] += applied
+
+    logger.info(f"[読み込み完了] {table} {total}")
+    return total
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="users / user_wishes の一括書き出し・読み込み")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="DBの内容をファイルに書き出す")
+    export_parser.add_argument("table", choices=sorted(COLUMNS))
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    export_parser.add_argument("-o", "--output", help="出力先（省略時は標準出力）")
+
+    import_parser = subparsers.add_parser("import", help="ファイルの内容をDBに登録する")
+    import_parser.add_argument("table", choices=sorted(COLUMNS))
+    import_parser.add_argument("input", help="入力ファイル（- で標準入力）")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="省略時は拡張子から判断（.jsonlならJSONL、それ以外はCSV）")
+    import_parser.add_argument("--cancel", action="store_true", help="登録ではなく解除する（user_wishesのみ）")
+
+    for sub in (export_parser, import_parser):
+        sub.add_argument("--batch-size", type=int, default=BATCH_PAGE_SIZE, help="1回のDB往復で扱う行数")
+
+    args = parser.parse_args(argv)
+    setup_logging()
+    if not ensure_schema():
+        logger.error("DBスキーマを準備できないため終了します")
+        return 1
+
+    if args.command == "export":
+        out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+        try:
+            export_rows(args.table, out, args.format, args.batch_size)
+        finally:
+            if args.output:
+                out.close()
+        return 0
+
+    if args.cancel and args.table != "user_wishes":
+        parser.error("--cancel は user_wishes にのみ指定できます")
+    fmt = args.format or ("jsonl" if args.input.endswith(".jsonl") else "csv")
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8-sig", newline="")
+    try:
+        total = import_rows(args.table, src, fmt, args.cancel, args.batch_size)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+    return 1 if total["failed_batches"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
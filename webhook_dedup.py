@@ -0,0 +1,38 @@
+# webhook_dedup.py
+
+from collections import OrderedDict
+import time
+import threading
+
+# 最近受け取ったwebhookEventIdを覚えておく、件数上限と有効期間つきの集合
+# LINEの再送（応答が遅れたときなど）で同じイベントを2回処理しないために使う
+class RecentEventIds:
+
+    def __init__(self, ttl_seconds=3600, max_size=10000):
+        self._ttl = ttl_seconds
+        self._max_size = max_size
+        self._seen = OrderedDict()  # event_id -> 受け取った時刻　古い順
+        self._lock = threading.Lock()
+
+    # 初めて見たIDならTrueを返して覚える　有効期間内に見たことがあればFalse
+    def add(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            # 期限切れを古い順に捨てる
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self._ttl:
+                    break
+                del self._seen[oldest_id]
+
+            if event_id in self._seen:
+                return False
+
+            self._seen[event_id] = now
+            while len(self._seen) > self._max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._seen)
@@ -0,0 +1,130 @@
+# webhook_queue.py
+
+import os
+import queue
+import time
+import logging
+import threading
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # ワーカーを止めるための目印
+
+# webhookイベントを上限付きキューに積み、ワーカースレッドで処理する
+# webhookの応答をDBやLINE APIの遅さから切り離すため
+class EventWorkerPool:
+
+    def __init__(self, dispatch, workers=4, max_size=100, enqueue_timeout=0.5):
+        self._dispatch = dispatch
+        self._workers = workers
+        self._max_size = max_size
+        self._enqueue_timeout = enqueue_timeout
+        self._reset()
+        # fork（gunicorn --preload）した子プロセスには親のワーカースレッドがないので、未起動の状態からやり直す
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue(maxsize=self._max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = False
+        self._busy = 0
+        self._stats = {
+            "enqueued": 0,  # キューに積んだイベント数
+            "processed": 0,  # 処理が終わったイベント数
+            "failed": 0,  # 処理中に例外が出たイベント数
+            "overflow": 0,  # キューが満杯でwebhookスレッドが自分で処理したイベント数
+            "high_water": 0,  # キューに溜まったイベント数の最大値
+            "wait_seconds_total": 0.0  # キューで待った時間の合計
+        }
+
+    # ワーカースレッドを起動する　このプロセスで起動済みならFalse
+    def start(self):
+        with self._lock:
+            if self._accepting:
+                return False
+            self._accepting = True
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"[イベントキュー起動] ワーカー {self._workers} 件, 上限 {self._queue.maxsize} 件")
+        return True
+
+    # イベントをキューに積む　満杯のまま待っても空かなければ、呼び出し元のスレッドでそのまま処理する（取りこぼさない）
+    def submit(self, event):
+        if self._accepting:
+            try:
+                self._queue.put((time.monotonic(), event), timeout=self._enqueue_timeout)
+                self._count("enqueued")
+                with self._lock:
+                    self._stats["high_water"] = max(self._stats["high_water"], self._queue.qsize())
+                return True
+            except queue.Full:
+                logger.warning(f"[イベントキュー満杯] 上限 {self._queue.maxsize} 件 → webhookスレッドで処理します")
+
+        self._count("overflow")
+        self._handle(event)
+        return False
+
+    # 新しいイベントの受付を止め、溜まっているイベントを処理し終えるまで最大timeout秒待つ
+    def shutdown(self, timeout=10.0):
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        remaining = self._queue.qsize()
+        if remaining:
+            logger.warning(f"[イベントキュー停止] 未処理のまま {remaining} 件を破棄しました")
+        logger.info(f"[イベントキュー停止] {self.stats()}")
+
+    # 監視用の統計値
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["busy_workers"] = self._busy
+        stats["queued"] = self._queue.qsize()
+        stats["max_size"] = self._queue.maxsize
+        stats["workers"] = self._workers
+        return stats
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                enqueued_at, event = item
+                with self._lock:
+                    self._stats["wait_seconds_total"] += time.monotonic() - enqueued_at
+                    self._busy += 1
+                try:
+                    self._handle(event)
+                finally:
+                    with self._lock:
+                        self._busy -= 1
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, event):
+        try:
+            self._dispatch(event)
+            self._count("processed")
+        except Exception as e:
+            self._count("failed")
+            logger.error(f"[イベント処理エラー] {type(event).__name__}: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
@@ -0,0 +1,170 @@
+# wish_conditions.py
+
+from calendar import monthrange
+from datetime import date, timedelta
+import re
+
+# 希望（ユーザー×施設）ごとの通知条件
+#   date_from / date_to: 宿泊開始日の範囲（"YYYY-MM-DD"、Noneなら制限なし）
+#   weekdays: 宿泊開始日の曜日のビット（月曜=1, 火曜=2, ... 日曜=64、Noneなら全曜日）
+#   min_nights: 連続して空いている泊数の下限（2なら翌日も空いている日だけ）
+# スキャン計画では、希望者全員の条件を合わせて必要な月だけを取りに行く
+
+WEEKDAY_NAMES = "月火水木金土日"  # datetime.weekday() の順
+WEEKDAY_ALIASES = {"平日": 0b0011111, "週末": 0b1100000}
+MAX_NIGHTS = 14
+
+NO_CONDITIONS = {"date_from": None, "date_to": None, "weekdays": None, "min_nights": 1}
+
+DATE_RE = re.compile(r"^(?:(\d{4})[-/])?(\d{1,2})[-/](\d{1,2})$")
+NIGHTS_RE = re.compile(r"^(\d+)泊(?:以上)?$")
+RANGE_SEPARATORS = ("〜", "～", "~")
+
+# user_wishesの行（date_from, date_to, weekdays, min_nights）から条件を作る
+def conditions_from_row(row):
+    return {
+        "date_from": _to_text(row.get("date_from")),
+        "date_to": _to_text(row.get("date_to")),
+        "weekdays": row.get("weekdays"),
+        "min_nights": row.get("min_nights") or 1
+    }
+
+def _to_text(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+def has_conditions(conditions):
+    return conditions != NO_CONDITIONS
+
+# 同じ条件の希望者をまとめて判定するためのキー
+def conditions_key(conditions):
+    return (conditions["date_from"], conditions["date_to"], conditions["weekdays"], conditions["min_nights"])
+
+# 「条件」コマンドの指定（"12/1〜12/31" "金土" "2泊" など）を条件にする　読めない指定は ValueError
+# "なし" で条件を外す
+def parse_conditions(tokens, today=None):
+    today = today or date.today()
+    conditions = dict(NO_CONDITIONS)
+    if list(tokens) == ["なし"]:
+        return conditions
+
+    for token in tokens:
+        nights = NIGHTS_RE.match(token)
+        if nights:
+            conditions["min_nights"] = int(nights.group(1))
+            if not 1 <= conditions["min_nights"] <= MAX_NIGHTS:
+                raise ValueError(f"泊数は1〜{MAX_NIGHTS}で指定してください: {token}")
+            continue
+
+        weekdays = _parse_weekdays(token)
+        if weekdays is not None:
+            conditions["weekdays"] = weekdays
+            continue
+
+        separator = next((s for s in RANGE_SEPARATORS if s in token), None)
+        if separator is None:
+            raise ValueError(f"読み取れない指定です: {token}")
+        # 年を省いた終了日は今日以降で一番近い日、開始日は終了日以前で一番近い日（終了日がなければ今月の1日以降）
+        # "10/1〜10/31" を10月中に送ったときも今年の10月になる（過ぎた日はどのみち通知しない）
+        start, _, end = token.partition(separator)
+        end_date = _parse_date(end, not_before=today) if end else None
+        if start:
+            if end_date:
+                conditions["date_from"] = _parse_date(start, not_after=end_date).isoformat()
+            else:
+                conditions["date_from"] = _parse_date(start, not_before=today.replace(day=1)).isoformat()
+        if end_date:
+            conditions["date_to"] = end_date.isoformat()
+
+    if conditions["date_from"] and conditions["date_to"] and conditions["date_from"] > conditions["date_to"]:
+        raise ValueError("開始日が終了日より後になっています")
+    return conditions
+
+def _parse_weekdays(token):
+    if token in WEEKDAY_ALIASES:
+        return WEEKDAY_ALIASES[token]
+    token = token.replace("曜日", "").replace("曜", "")
+    if not token or any(char not in WEEKDAY_NAMES for char in token):
+        return None
+    return sum(1 << WEEKDAY_NAMES.index(char) for char in set(token))
+
+# "2026-12-01" / "2026/12/1" / "12/1"
+# 年を省いたときは not_before 以降で一番近い日、または not_after 以前で一番近い日にする
+def _parse_date(text, not_before=None, not_after=None):
+    match = DATE_RE.match(text)
+    if not match:
+        raise ValueError(f"日付が読み取れません: {text}")
+    year, month, day = match.groups()
+    try:
+        if year:
+            return date(int(year), int(month), int(day))
+        if not_after:
+            parsed = date(not_after.year, int(month), int(day))
+            return parsed if parsed <= not_after else date(not_after.year - 1, int(month), int(day))
+        parsed = date(not_before.year, int(month), int(day))
+        return parsed if parsed >= not_before else date(not_before.year + 1, int(month), int(day))
+    except ValueError:
+        raise ValueError(f"存在しない日付です: {text}")
+
+# 条件を「12/1〜12/31・金土・2泊以上」のような文にする
+def format_conditions(conditions):
+    parts = []
+    if conditions["date_from"] or conditions["date_to"]:
+        parts.append(f"{_format_date(conditions['date_from'])}〜{_format_date(conditions['date_to'])}")
+    if conditions["weekdays"] is not None:
+        parts.append("".join(name for i, name in enumerate(WEEKDAY_NAMES) if conditions["weekdays"] & (1 << i)))
+    if conditions["min_nights"] > 1:
+        parts.append(f"{conditions['min_nights']}泊以上")
+    return "・".join(parts) or "条件なし"
+
+def _format_date(value):
+    if not value:
+        return ""
+    parsed = date.fromisoformat(value)
+    return f"{parsed.month}/{parsed.day}" if parsed.year == date.today().year else f"{parsed.year}/{parsed.month}/{parsed.day}"
+
+# 空き日（"YYYY-MM-DD"の昇順）のうち条件に合う宿泊開始日を返す
+# available には連泊の判定に使う空き日の集合を渡す（省略時は dates）
+def filter_dates(dates, conditions, available=None):
+    if not has_conditions(conditions):
+        return tuple(dates)
+
+    available = set(dates) if available is None else available
+    matched = []
+    for text in dates:
+        if conditions["date_from"] and text < conditions["date_from"]:
+            continue
+        if conditions["date_to"] and text > conditions["date_to"]:
+            continue
+        day = date.fromisoformat(text)
+        if conditions["weekdays"] is not None and not conditions["weekdays"] & (1 << day.weekday()):
+            continue
+        if any((day + timedelta(days=n)).isoformat() not in available for n in range(1, conditions["min_nights"])):
+            continue
+        matched.append(text)
+    return tuple(matched)
+
+# months（各月の1日）のうち、条件の期間（連泊の分を含む）にかかる月を返す
+def needed_months(conditions, months):
+    start = conditions["date_from"]
+    end = conditions["date_to"]
+    if end:
+        end = (date.fromisoformat(end) + timedelta(days=conditions["min_nights"] - 1)).isoformat()
+
+    needed = []
+    for first_day in months:
+        last_day = first_day.replace(day=monthrange(first_day.year, first_day.month)[1])
+        if end and first_day.strftime("%Y-%m-%d") > end:
+            continue
+        if start and last_day.strftime("%Y-%m-%d") < start:
+            continue
+        needed.append(first_day)
+    return needed
+
+# 複数の希望者の条件から、1施設で取りに行く月（months の順）を返す
+def union_months(conditions_list, months):
+    needed = set()
+    for conditions in conditions_list:
+        if conditions["date_from"] is None and conditions["date_to"] is None:
+            return list(months)
+        needed.update(needed_months(conditions, months))
+    return [first_day for first_day in months if first_day in needed]